@@ -0,0 +1,82 @@
+from inventree_supplier_panel.parallel_lookup import ParallelLookup
+from inventree_supplier_panel.price_comparison import PriceComparison
+from inventree_supplier_panel.supplier_registry import SupplierRegistry
+
+from decimal import Decimal, ROUND_CEILING
+
+# ----------------------------------------------------------------------------
+# Check of all lines of a PO against the part data of the supplier before the
+# cart is created. The part data of all lines is looked up in one parallel run
+# and comes from the part data cache when possible. Each line gets a list of
+# problems: minimum order quantity, order multiple, first price break and
+# stock. For lines with a wrong quantity the next valid quantity is suggested
+# in the unit of the PO line.
+# Some suppliers get the quantity in packs and some in parts. The supplier
+# definition says which, with cart_in_packs.
+
+
+class AvailabilityCheck():
+
+    # ------------------------------- check_order ----------------------------
+    def check_order(self, order, use_cache=True):
+        supplier = SupplierRegistry.get_supplier(self, order.supplier.pk)
+        if supplier is None:
+            return {'message': 'Supplier of the order is not registered'}
+        items = list(order.lines.filter(part__isnull=False).select_related('part__part'))
+        all_data = ParallelLookup.get_partdata_many(self, [(order.supplier.pk, item.part.SKU, 'exact') for item in items], use_cache=use_cache)
+        lines = []
+        for item, data in zip(items, all_data):
+            lines.append(AvailabilityCheck.check_line(self, item, data, supplier.get('cart_in_packs', False)))
+        return {'message': 'OK',
+                'lines': lines,
+                'problems': len([line for line in lines if line['problems'] != []]),
+                }
+
+    # ------------------------------- check_line -----------------------------
+    def check_line(self, item, data, in_packs):
+        try:
+            pack = max(1, int(item.part.pack_quantity))
+        except Exception:
+            pack = 1
+        if not in_packs:
+            pack = 1
+        quantity = int(item.quantity) * pack
+        line = {'pk': item.pk,
+                'SKU': item.part.SKU,
+                'IPN': item.part.part.IPN,
+                'quantity': quantity,
+                'stock': None,
+                'moq': None,
+                'mult': None,
+                'suggested_quantity': None,
+                'problems': [],
+                }
+        if data['error_status'] != 'OK':
+            line['problems'].append(str(data['error_status']))
+            return line
+        if data['number_of_results'] == 0:
+            line['problems'].append('Part not found at the supplier')
+            return line
+
+        line['stock'] = data.get('stock', 0)
+        line['moq'] = data.get('moq', 1)
+        try:
+            line['mult'] = max(1, int(data.get('mult', 1)))
+        except Exception:
+            line['mult'] = 1
+        first_break = Decimal(1)
+        if data['price_breaks'] != []:
+            first_break = min(Decimal(str(pb['Quantity'])) for pb in data['price_breaks'])
+        order_quantity = int(PriceComparison.get_order_quantity(self, quantity, line['moq'], line['mult'], first_break))
+
+        if quantity < line['moq']:
+            line['problems'].append(f"Below the minimum order quantity of {line['moq']}")
+        elif quantity < first_break:
+            line['problems'].append(f'Below the first price break of {first_break}')
+        if quantity % line['mult'] != 0:
+            line['problems'].append(f"Not a multiple of {line['mult']}")
+        if line['stock'] < order_quantity:
+            line['problems'].append(f"Only {line['stock']} in stock")
+        if order_quantity != quantity:
+            line['suggested_quantity'] = int((Decimal(order_quantity) / pack).to_integral_value(rounding=ROUND_CEILING))
+        return line
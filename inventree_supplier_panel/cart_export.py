@@ -0,0 +1,115 @@
+from django.http import StreamingHttpResponse
+
+from order.models import PurchaseOrder
+from inventree_supplier_panel.cart_snapshot import CartSnapshots
+
+import csv
+import json
+
+# ----------------------------------------------------------------------------
+# Export of the transferred carts as CSV, NDJSON or quick paste text. The
+# export is a generator that is consumed by a StreamingHttpResponse. The orders
+# and the lines of the cart snapshots are read one by one and each line is
+# written as soon as it is ready, so the memory does not grow with the number
+# of orders or lines. Each line contains the cart item, the availability from
+# the supplier and the price breaks of the supplier part. HasError is only in
+# the NDJSON export.
+
+FIELDS = ['order',
+          'supplier',
+          'SKU',
+          'IPN',
+          'Manufacturer',
+          'MPN',
+          'Description',
+          'QuantityRequested',
+          'QuantityAvailable',
+          'UnitPrice',
+          'ExtendedPrice',
+          'currency_code',
+          'Error',
+          'price_breaks',
+          ]
+
+CONTENT_TYPES = {'csv': 'text/csv',
+                 'ndjson': 'application/x-ndjson',
+                 'txt': 'text/plain',
+                 }
+
+
+# The csv writer needs a file. This one just returns the line.
+class Echo():
+
+    def write(self, value):
+        return value
+
+
+class CartExport():
+
+    # ------------------------------- get_response ---------------------------
+    def get_response(self, pks, format):
+        rows = CartExport.get_rows(self, pks)
+        if format == 'csv':
+            lines = CartExport.csv_lines(self, rows)
+        elif format == 'txt':
+            lines = CartExport.quick_paste_lines(self, rows)
+        else:
+            lines = CartExport.ndjson_lines(self, rows)
+        response = StreamingHttpResponse(lines, content_type=CONTENT_TYPES[format])
+        response['Content-Disposition'] = 'attachment; filename="cart_export.' + format + '"'
+        return response
+
+    # ------------------------------- get_rows -------------------------------
+    # Yields one dict per cart item of the latest cart of each order. Orders
+    # without a transferred cart are skipped. The price breaks of all lines of
+    # an order are read in one query.
+    def get_rows(self, pks):
+        orders = PurchaseOrder.objects.filter(pk__in=pks).select_related('supplier').order_by('pk')
+        for order in orders.iterator():
+            snapshot = CartSnapshots.get_snapshot(self, order)
+            if snapshot is None:
+                continue
+            currency_code = snapshot.currency_code
+            items = CartSnapshots.get_items(self, snapshot)
+            price_breaks = {}
+            for line in order.lines.filter(part__isnull=False).select_related('part').prefetch_related('part__pricebreaks'):
+                price_breaks[line.part.SKU] = [{'quantity': str(pb.quantity),
+                                                'price': str(pb.price.amount),
+                                                'currency': str(pb.price_currency),
+                                                } for pb in line.part.pricebreaks.all()]
+            for item in items:
+                row = {'order': order.reference,
+                       'supplier': order.supplier.name,
+                       'currency_code': currency_code,
+                       'price_breaks': price_breaks.get(item['SKU'], []),
+                       'HasError': item.get('HasError', False),
+                       }
+                for field in FIELDS:
+                    if field not in row:
+                        row[field] = item.get(field, '')
+                yield row
+
+    # ------------------------------- csv_lines ------------------------------
+    # The price breaks are written into one column as quantity:price pairs.
+    def csv_lines(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(FIELDS)
+        for row in rows:
+            values = [row[field] for field in FIELDS[:-1]]
+            values.append(' '.join(pb['quantity'] + ':' + pb['price'] for pb in row['price_breaks']))
+            yield writer.writerow(values)
+
+    # ------------------------------- quick_paste_lines ----------------------
+    # SKU, quantity and IPN as line note. This can be pasted into the quick
+    # paste form of the Farnell basket and into the BOM import of the other
+    # suppliers. Items with errors like unknown parts or a quantity below the
+    # minimum are left out. They are shown in the panel.
+    def quick_paste_lines(self, rows):
+        for row in rows:
+            if not row.get('HasError', False):
+                yield f"{row['SKU']}, {row['QuantityRequested']}, {row['IPN']}\n"
+
+    # ------------------------------- ndjson_lines ---------------------------
+    def ndjson_lines(self, rows):
+        for row in rows:
+            yield json.dumps(row) + '\n'
@@ -0,0 +1,187 @@
+from django.db import transaction
+from django.db.models import F
+
+from inventree_supplier_panel.meta_access import MetaAccess
+from inventree_supplier_panel.models import CartSnapshot, CartSnapshotLine
+
+from decimal import Decimal
+
+# ----------------------------------------------------------------------------
+# Storage of the transferred carts in the plugin tables. A transfer writes one
+# snapshot row and all cart lines with one bulk_create. The order metadata gets
+# only a small pointer with the pk of the latest snapshot, the cart key and the
+# date. Orders that were transferred with older plugin versions still have the
+# complete cart in the metadata. It is moved into a snapshot when it is read
+# for the first time.
+# The panel reads the lines page by page. Sorting, filtering and paging are
+# done in the database, so the cost of a page does not depend on the size of
+# the cart.
+
+BATCH_SIZE = 500
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Sort keys of the lines endpoint and the fields behind them
+SORT_FIELDS = {'position': 'position',
+               'SKU': 'SKU',
+               'IPN': 'IPN',
+               'QuantityRequested': 'quantity_requested',
+               'QuantityAvailable': 'quantity_available',
+               'UnitPrice': 'unit_price',
+               'ExtendedPrice': 'extended_price',
+               'Error': 'error',
+               }
+FILTERS = ['', 'errors', 'unavailable']
+
+
+class CartSnapshots():
+
+    # ------------------------------- store_snapshot -------------------------
+    # Returns the pointer that goes into the order metadata.
+    def store_snapshot(self, order, cart_data):
+        with transaction.atomic():
+            snapshot = CartSnapshot.objects.create(order=order,
+                                                   supplier=order.supplier.name[:100],
+                                                   cart_key=str(cart_data.get('cart_key') or '')[:250],
+                                                   cart_date=cart_data['cart_date'],
+                                                   currency_code=str(cart_data.get('currency_code') or '')[:3],
+                                                   merchandise_total=CartSnapshots.get_decimal(self, cart_data.get('MerchandiseTotal')),
+                                                   line_count=len(cart_data['CartItems']),
+                                                   )
+            lines = []
+            for position, item in enumerate(cart_data['CartItems']):
+                lines.append(CartSnapshotLine(snapshot=snapshot,
+                                              position=position,
+                                              SKU=str(item.get('SKU', ''))[:250],
+                                              IPN=str(item.get('IPN') or '')[:250],
+                                              MPN=str(item.get('MPN', ''))[:250],
+                                              manufacturer=str(item.get('Manufacturer', ''))[:250],
+                                              description=str(item.get('Description', '')),
+                                              quantity_requested=CartSnapshots.get_int(self, item.get('QuantityRequested')),
+                                              quantity_available=CartSnapshots.get_int(self, item.get('QuantityAvailable')),
+                                              unit_price=CartSnapshots.get_decimal(self, item.get('UnitPrice')),
+                                              extended_price=CartSnapshots.get_decimal(self, item.get('ExtendedPrice')),
+                                              error=str(item.get('Error', '')),
+                                              has_error=bool(item.get('HasError', False)),
+                                              ))
+            CartSnapshotLine.objects.bulk_create(lines, batch_size=BATCH_SIZE)
+        return {'snapshot': snapshot.pk,
+                'cart_key': snapshot.cart_key,
+                'cart_date': str(snapshot.cart_date),
+                'currency_code': snapshot.currency_code,
+                'MerchandiseTotal': float(snapshot.merchandise_total),
+                'lines': snapshot.line_count,
+                }
+
+    def get_int(self, value):
+        try:
+            return int(value)
+        except Exception:
+            return 0
+
+    def get_decimal(self, value):
+        try:
+            return Decimal(str(value)).quantize(Decimal('0.000001'))
+        except Exception:
+            return Decimal(0)
+
+    # ------------------------------- get_snapshot ---------------------------
+    # The latest snapshot of the order or the one with the given pk. None for
+    # orders without snapshot.
+    def get_snapshot(self, order, pk=None):
+        if pk is None:
+            pointer = MetaAccess.get_value(self, order, 'cart')
+            if pointer is None:
+                return None
+            if 'CartItems' in pointer:
+                pointer = CartSnapshots.move_to_snapshot(self, order)
+            pk = pointer['snapshot']
+        return CartSnapshot.objects.filter(order=order, pk=pk).first()
+
+    # Replaces a complete cart in the metadata of an older version by a snapshot.
+    # The order row is locked, so parallel first reads move the cart only once.
+    # The metadata of order is updated too, so a later save does not bring the
+    # old cart back. Older versions did not store HasError. Error items of
+    # Mouser and Digikey have no MPN and no manufacturer.
+    def move_to_snapshot(self, order):
+        with transaction.atomic():
+            locked = type(order).objects.select_for_update().get(pk=order.pk)
+            pointer = MetaAccess.get_value(self, locked, 'cart')
+            if 'CartItems' in pointer:
+                cart = pointer
+                cart.setdefault('cart_date', str(locked.creation_date))
+                for item in cart['CartItems']:
+                    item.setdefault('HasError', not item.get('MPN') and not item.get('Manufacturer'))
+                pointer = CartSnapshots.store_snapshot(self, locked, cart)
+                MetaAccess.set_value(self, locked, 'cart', pointer)
+        order.metadata = locked.metadata
+        return pointer
+
+    # ------------------------------- get_cart -------------------------------
+    # The cart in the format of the transfer with all items.
+    def get_cart(self, order, pk=None):
+        snapshot = CartSnapshots.get_snapshot(self, order, pk)
+        if snapshot is None:
+            return None
+        cart = CartSnapshots.get_header(self, snapshot)
+        cart['CartItems'] = list(CartSnapshots.get_items(self, snapshot))
+        return cart
+
+    def get_header(self, snapshot):
+        return {'snapshot': snapshot.pk,
+                'pk': snapshot.order_id,
+                'cart_key': snapshot.cart_key,
+                'cart_date': str(snapshot.cart_date),
+                'currency_code': snapshot.currency_code,
+                'MerchandiseTotal': float(snapshot.merchandise_total),
+                'lines': snapshot.line_count,
+                }
+
+    # ------------------------------- get_items ------------------------------
+    # Yields the cart items of a snapshot without creating model instances.
+    def get_items(self, snapshot, lines=None):
+        if lines is None:
+            lines = snapshot.lines.values()
+        for line in lines.iterator():
+            yield {'SKU': line['SKU'],
+                   'IPN': line['IPN'],
+                   'MPN': line['MPN'],
+                   'Manufacturer': line['manufacturer'],
+                   'Description': line['description'],
+                   'QuantityRequested': line['quantity_requested'],
+                   'QuantityAvailable': line['quantity_available'],
+                   'UnitPrice': float(line['unit_price']),
+                   'ExtendedPrice': float(line['extended_price']),
+                   'Error': line['error'],
+                   'HasError': line['has_error'],
+                   }
+
+    # ------------------------------- get_page -------------------------------
+    # One page of the lines of a snapshot. sort is a key of SORT_FIELDS with an
+    # optional - for descending order. The position makes the order stable.
+    def get_page(self, snapshot, offset=0, limit=DEFAULT_PAGE_SIZE, sort='position', filter=''):
+        lines = snapshot.lines.all()
+        if filter == 'errors':
+            lines = lines.filter(has_error=True)
+        elif filter == 'unavailable':
+            lines = lines.filter(quantity_available__lt=F('quantity_requested'))
+        field = SORT_FIELDS[sort.lstrip('-')]
+        if sort.startswith('-'):
+            lines = lines.order_by('-' + field, 'position')
+        else:
+            lines = lines.order_by(field, 'position')
+        page = CartSnapshots.get_header(self, snapshot)
+        page['count'] = snapshot.line_count if filter == '' else lines.count()
+        page['offset'] = offset
+        page['limit'] = limit
+        page['sort'] = sort
+        page['filter'] = filter
+        page['CartItems'] = list(CartSnapshots.get_items(self, snapshot, lines.values()[offset:offset + limit]))
+        return page
+
+    # ------------------------------- get_history ----------------------------
+    def get_history(self, order):
+        history = []
+        for snapshot in CartSnapshot.objects.filter(order=order).order_by('-created', '-pk'):
+            history.append(CartSnapshots.get_header(self, snapshot))
+        return history
@@ -1,9 +1,50 @@
-from common.models import InvenTreeSetting
+from django.db import connection, transaction
 
-from inventree_supplier_panel.request_wrappers import Wrappers
+from plugin.models import PluginSetting
+from inventree_supplier_panel.settings_cache import SettingsCache, PLUGIN_KEY
+from inventree_supplier_panel.request_wrappers import Wrappers, RequestNotSent, TooManyRequests
 from inventree_supplier_panel.meta_access import MetaAccess
+from inventree_supplier_panel.instrumentation import Instrumentation
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 import json
+import re
+import threading
+import time
+
+# ----------------------------------------------------------------------------
+# Cache for the Digikey access token. The token is valid for expires_in seconds
+# after the refresh. We refresh only when it expires within TOKEN_MARGIN seconds.
+# Each refresh invalidates the previous refresh token. So only one thread of all
+# server processes and the background worker may refresh at a time. The lock
+# does this for the threads of one process. Between the processes the row of
+# the refresh token in the database is locked. The expiry is stored next to the
+# token, so a process reads the token that another process got before it
+# refreshes on its own.
+
+TOKEN_MARGIN = 60
+
+token_cache = {'access_token': None,
+               'expires_at': 0,
+               'hits': 0,
+               'misses': 0,
+               }
+token_lock = threading.Lock()
+
+# ----------------------------------------------------------------------------
+# The parts of a list are uploaded in chunks of DIGIKEY_CHUNK_SIZE parts. The
+# chunks are sent in parallel. Adding parts to a list is not idempotent. So a
+# chunk is sent again as is only when Digikey did not get it: on 429 and when
+# the connection could not be opened. After a server error or a lost answer it
+# is unknown which parts Digikey added. When all chunks are done, the list is
+# read back and only the missing parts of these chunks are sent again. This is
+# done up to CHUNK_RETRIES times.
+
+DEFAULT_CHUNK_SIZE = 50
+DEFAULT_UPLOAD_WORKERS = 4
+CHUNK_RETRIES = 2
+CHUNK_RETRY_DELAY = 1
 
 
 class Digikey():
@@ -15,7 +56,7 @@ class Digikey():
 
     def get_digikey_partdata_v4(self, sku, options):
         part_data = {}
-        token = Digikey.refresh_digikey_access_token(self)
+        token = Digikey.get_digikey_access_token(self)
         if token['status_code'] != 200:
             part_data['error_status'] = token['message']
             return part_data
@@ -23,20 +64,23 @@ class Digikey():
         # replace invalid characters in the partnumber
         sku = quote(sku, safe='')
         url = f'https://api.digikey.com/products/v4/search/{sku}/productdetails'
-        country_code = self.COUNTRY_CODES[InvenTreeSetting.get_setting('INVENTREE_DEFAULT_CURRENCY')]
+        currency_code = SettingsCache.get_global_setting(self, 'INVENTREE_DEFAULT_CURRENCY')
+        country_code = self.COUNTRY_CODES[currency_code]
         header = {
-            'Authorization': f"{'Bearer'} {self.get_setting('DIGIKEY_TOKEN')}",
+            'Authorization': f"{'Bearer'} {Digikey.get_access_token(self)}",
             'X-DIGIKEY-Client-Id': self.get_setting('DIGIKEY_CLIENT_ID'),
             'Content-Type': 'application/json',
-            'X-DIGIKEY-Locale-Currency': InvenTreeSetting.get_setting('INVENTREE_DEFAULT_CURRENCY'),
+            'X-DIGIKEY-Locale-Currency': currency_code,
             'X-DIGIKEY-Locale-Site': country_code,
             'X-DIGIKEY-Locale-Language': 'EN'
         }
         response = Wrappers.get_request(self, url, headers=header)
+        if response.status_code == 401:
+            Digikey.invalidate_digikey_token(self)
         try:
-            response_json = response.json()
+            response_json = Wrappers.get_json(self, response)
         except Exception:
-            part_data['error_status'] = response
+            part_data['error_status'] = str(response.content)
             return part_data
         # print(response_json)
 
@@ -47,7 +91,6 @@ class Digikey():
                 return part_data
         except Exception:
             pass
-        print('Remaining requests:', response.headers['X-RateLimit-Remaining'])
 
         # Select the right variation that fits the searched SKU
         for product in response_json['Product']['ProductVariations']:
@@ -69,6 +112,11 @@ class Digikey():
             part_data['pack_quantity'] = '1'
         else:
             part_data['pack_quantity'] = str(product['MinimumOrderQuantity'])
+        part_data['moq'] = max(1, product['MinimumOrderQuantity'])
+        try:
+            part_data['stock'] = int(product['QuantityAvailableforPackageType'])
+        except Exception:
+            part_data['stock'] = 0
         for pb in product['StandardPricing']:
             part_data['price_breaks'].append({'Quantity': pb['BreakQuantity'],
                                               'Price': pb['UnitPrice'],
@@ -81,31 +129,40 @@ class Digikey():
     # The list can easily be converted to a shopping cart or a quote in the
     # WEB UI of Digikey. However the List API is not so simple to handle because
     # all the list names are stored and blocked for future use. Even deleted ones..
+    # So we take the names of the existing lists from Digikey and the names that
+    # this order used before from the metadata. The next free name is computed
+    # from both and validated once. Only if Digikey still rejects it, we probe
+    # the following names one by one.
 
     def create_digikey_cart(self, order):
         cart_data = {}
-        list_name = MetaAccess.get_value(self, order, 'DigiKeyListName')
-        if list_name is None:
-            list_name = order.reference + '-00'
-        version = int(list_name[len(list_name) - 2:]) + 1
-        token = Digikey.refresh_digikey_access_token(self)
+        token = Digikey.get_digikey_access_token(self)
 
         if token['status_code'] != 200:
             cart_data['error_status'] = token['message']
             return cart_data
+        used_names = list(MetaAccess.get_value(self, order, 'DigiKeyListNames') or [])
+        last_name = MetaAccess.get_value(self, order, 'DigiKeyListName')
+        if last_name is not None:
+            used_names.append(last_name)
+        used_names = used_names + Digikey.get_digikey_listnames(self)
+        version = Digikey.get_next_list_version(self, order.reference, used_names)
         list_name = order.reference + '-' + str(version).zfill(2)
         i = version
         while not Digikey.check_valid_listname(self, list_name):
+            used_names.append(list_name)
             i = i + 1
             list_name = order.reference + '-' + str(i).zfill(2)
             if i == version + 20:
                 cart_data['ID'] = ''
                 cart_data['error_status'] = 'No valid list name found within 20 attempts'
                 return cart_data
+        used_names.append(list_name)
+        MetaAccess.set_value(self, order, 'DigiKeyListNames', Digikey.get_order_listnames(self, order.reference, used_names))
         MetaAccess.set_value(self, order, 'DigiKeyListName', list_name)
         url = 'https://api.digikey.com/mylists/v1/lists'
         header = {
-            'Authorization': f"{'Bearer'} {self.get_setting('DIGIKEY_TOKEN')}",
+            'Authorization': f"{'Bearer'} {Digikey.get_access_token(self)}",
             'X-DIGIKEY-Client-Id': self.get_setting('DIGIKEY_CLIENT_ID'),
             'Content-Type': 'application/json'
         }
@@ -115,15 +172,46 @@ class Digikey():
         }
         response = Wrappers.post_request(self, json.dumps(url_data), url, headers=header)
 #        self.status_code = response.status_code
-        cart_data['ID'] = response.json()
+        cart_data['ID'] = Wrappers.get_json(self, response)
         cart_data['error_status'] = 'OK'
         return (cart_data)
 
+    # ------------------------------- list names -----------------------------
+    # The names of all lists in the Digikey account. Empty if the request fails.
+    # In this case the validation below still finds a free name.
+    def get_digikey_listnames(self):
+        url = 'https://api.digikey.com/mylists/v1/lists'
+        header = {
+            'Authorization': f"{'Bearer'} {Digikey.get_access_token(self)}",
+            'X-DIGIKEY-Client-Id': self.get_setting('DIGIKEY_CLIENT_ID'),
+            'accept': 'application/json'
+        }
+        try:
+            response = Wrappers.get_request(self, url, headers=header)
+            return [str(item['ListName']) for item in Wrappers.get_json(self, response)]
+        except Exception:
+            return []
+
+    # Only the names that belong to the order are kept in the metadata.
+    def get_order_listnames(self, reference, used_names):
+        pattern = re.compile(re.escape(reference) + r'-(\d+)$')
+        return sorted(set(name for name in used_names if pattern.match(name)))
+
+    # One above the highest version of the order in the used names.
+    def get_next_list_version(self, reference, used_names):
+        pattern = re.compile(re.escape(reference) + r'-(\d+)$')
+        version = 0
+        for name in used_names:
+            match = pattern.match(name)
+            if match:
+                version = max(version, int(match.group(1)))
+        return version + 1
+
     # Error status not checked !!!
     def check_valid_listname(self, list_name):
         url = f'https://api.digikey.com/mylists/v1/lists/validate/{list_name}'
         header = {
-            'Authorization': f"{'Bearer'} {self.get_setting('DIGIKEY_TOKEN')}",
+            'Authorization': f"{'Bearer'} {Digikey.get_access_token(self)}",
             'X-DIGIKEY-Client-Id': self.get_setting('DIGIKEY_CLIENT_ID'),
             'accept': 'application/json'
         }
@@ -137,24 +225,21 @@ class Digikey():
     def update_digikey_cart(self, order, list_id):
 
         pack_types = {'TR': 'full reel', 'DKR': 'DigiReel', 'CT': 'cut tape', 'BAG': 'bulk'}
-        url = f'https://api.digikey.com/mylists/v1/lists/{list_id}/parts'
-        header = {'Authorization': f"{'Bearer'} {self.get_setting('DIGIKEY_TOKEN')}",
-                  'X-DIGIKEY-Client-Id': self.get_setting('DIGIKEY_CLIENT_ID'),
-                  'accept': 'application/json',
-                  'Content-Type': 'application/json'
-                  }
         cart_items = []
-        for item in order.lines.all():
+        for item in order.lines.select_related('part__part'):
             cart_items.append({'RequestedPartNumber': item.part.SKU,
                                'Quantities': [{'Quantity': int(item.quantity) * int(item.part.pack_quantity)}],
-                               'CustomerReference': item.part.part.IPN
+                               'CustomerReference': item.part.part.IPN or ''
                                })
-        # The post equest just generates the list in the Digikey cloud
-        Wrappers.post_request(self, json.dumps(cart_items), url, header)
+        # The post requests just generate the list in the Digikey cloud
+        errors = Digikey.upload_digikey_parts(self, list_id, cart_items)
+        if errors != []:
+            return {'error_status': f'Upload of {len(errors)} chunks to Digikey failed: {errors[0]}'}
 
         # Now we get the parts from the generated list
         parts_in_list = Digikey.get_parts_in_list(self, list_id)
-        # print(parts_in_list)
+        if parts_in_list is None:
+            return {'error_status': 'Reading the list from Digikey failed'}
         cart_items = []
         merchandise_total = 0
         for p in parts_in_list['PartsList']:
@@ -183,6 +268,7 @@ class Digikey():
                                        'UnitPrice': 0,
                                        'ExtendedPrice': 0,
                                        'Error': 'Minimum order quantity not reached',
+                                       'HasError': True,
                                        })
                 else:
                     try:
@@ -212,33 +298,199 @@ class Digikey():
                                    'UnitPrice': 0,
                                    'ExtendedPrice': 0,
                                    'Error': 'Partnumber not found at Digikey',
+                                   'HasError': True,
                                    })
 
         # Digikey does not return a currency code. So we take the one from the settings.
         shopping_cart = {'MerchandiseTotal': merchandise_total,
                          'CartItems': cart_items,
                          'cart_key': MetaAccess.get_value(self, order, 'DigiKeyListName'),
-                         'currency_code': InvenTreeSetting.get_setting('INVENTREE_DEFAULT_CURRENCY'),
+                         'currency_code': SettingsCache.get_global_setting(self, 'INVENTREE_DEFAULT_CURRENCY'),
                          }
         shopping_cart['error_status'] = 'OK'
         return (shopping_cart)
 
+    # ------------------------------- upload_digikey_parts -------------------
+    # Sends the parts in chunks in parallel. Returns the errors of the chunks
+    # that failed after all retries.
+    def upload_digikey_parts(self, list_id, cart_items):
+        try:
+            chunk_size = max(1, int(self.get_setting('DIGIKEY_CHUNK_SIZE')))
+        except Exception:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        try:
+            workers = int(self.get_setting('SUPPLIER_CONCURRENCY'))
+        except Exception:
+            workers = DEFAULT_UPLOAD_WORKERS
+        url = f'https://api.digikey.com/mylists/v1/lists/{list_id}/parts'
+        header = {'Authorization': f"{'Bearer'} {Digikey.get_access_token(self)}",
+                  'X-DIGIKEY-Client-Id': self.get_setting('DIGIKEY_CLIENT_ID'),
+                  'accept': 'application/json',
+                  'Content-Type': 'application/json'
+                  }
+        trace = Instrumentation.get_trace(self)
+        errors = []
+        uploaded = []
+        for attempt in range(CHUNK_RETRIES + 1):
+            if attempt > 0:
+                time.sleep(CHUNK_RETRY_DELAY * attempt)
+            chunks = [cart_items[i:i + chunk_size] for i in range(0, len(cart_items), chunk_size)]
+            if chunks == []:
+                break
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+                results = list(executor.map(lambda chunk: Digikey.upload_digikey_chunk(self, url, header, chunk, trace), chunks))
+            unknown = []
+            unknown_errors = []
+            for chunk, (state, error) in zip(chunks, results):
+                if state == 'OK':
+                    uploaded.extend(chunk)
+                elif state == 'unknown':
+                    unknown.extend(chunk)
+                    unknown_errors.append(error)
+                else:
+                    errors.append(error)
+            if unknown == []:
+                break
+            found, cart_items = Digikey.get_missing_parts(self, list_id, unknown, uploaded)
+            if cart_items is None or attempt == CHUNK_RETRIES:
+                errors.extend(unknown_errors)
+                break
+            uploaded.extend(found)
+        return errors
+
+    # Runs in a worker thread. Returns the state of the chunk and the error.
+    # The state is OK, failed when Digikey did not take it or unknown when
+    # Digikey might have added a part of it. Only a chunk that Digikey did not
+    # get is sent again here. Client errors other than 429 are not retried.
+    def upload_digikey_chunk(self, url, header, chunk, trace=None):
+        error = ''
+        Instrumentation.set_trace(self, trace)
+        try:
+            for attempt in range(CHUNK_RETRIES + 1):
+                if attempt > 0:
+                    time.sleep(CHUNK_RETRY_DELAY * attempt)
+                try:
+                    response = Wrappers.post_request(self, json.dumps(chunk), url, header)
+                except TooManyRequests:
+                    return 'failed', 'Digikey request quota used up'
+                except RequestNotSent:
+                    error = 'Connection to Digikey failed'
+                    continue
+                except ConnectionError:
+                    return 'unknown', 'Connection to Digikey lost'
+                if response.status_code < 300:
+                    return 'OK', ''
+                error = str(response.status_code) + ' ' + str(response.content)
+                if response.status_code == 429:
+                    continue
+                if response.status_code >= 500:
+                    return 'unknown', error
+                break
+            return 'failed', error
+        finally:
+            Instrumentation.set_trace(self, None)
+            connection.close()
+
+    # Splits the items into the ones that are in the list and the missing ones.
+    # The list is counted per part number and reference. The parts that were
+    # uploaded for sure are taken away first, so a line with the same key in
+    # another chunk is not taken for one of the items. Digikey returns an empty
+    # reference for a line without one. The missing items are None if the list
+    # cannot be read.
+    def get_missing_parts(self, list_id, items, uploaded):
+        try:
+            parts_in_list = Digikey.get_parts_in_list(self, list_id)
+        except ConnectionError:
+            return [], None
+        if parts_in_list is None:
+            return [], None
+        in_list = Counter((p['RequestedPartNumber'], p['CustomerReference'] or '') for p in parts_in_list['PartsList'])
+        in_list.subtract((item['RequestedPartNumber'], item['CustomerReference'] or '') for item in uploaded)
+        found = []
+        missing = []
+        for item in items:
+            key = (item['RequestedPartNumber'], item['CustomerReference'] or '')
+            if in_list[key] > 0:
+                in_list[key] = in_list[key] - 1
+                found.append(item)
+            else:
+                missing.append(item)
+        return found, missing
+
     # ------------------------------- get_parts_in_list ----------------------
     def get_parts_in_list(self, list_id):
-        currency_code = InvenTreeSetting.get_setting('INVENTREE_DEFAULT_CURRENCY')
+        currency_code = SettingsCache.get_global_setting(self, 'INVENTREE_DEFAULT_CURRENCY')
         country_code = self.COUNTRY_CODES[currency_code]
         url = f'https://api.digikey.com/mylists/v1/lists/{list_id}/parts/?countryIso={country_code}&currencyIso={currency_code}&languageIso={country_code}'
         header = {
-            'Authorization': f"{'Bearer'} {self.get_setting('DIGIKEY_TOKEN')}",
+            'Authorization': f"{'Bearer'} {Digikey.get_access_token(self)}",
             'X-DIGIKEY-Client-Id': self.get_setting('DIGIKEY_CLIENT_ID'),
             'accept': 'application/json'
         }
         response = Wrappers.get_request(self, url, headers=header)
         if not response:
             return (None)
-        return (response.json())
+        return (Wrappers.get_json(self, response))
 
     # -------------------- Here starts the digikey token stuff --------------------
+    # Returns the cached access token in the same format as refresh_digikey_access_token
+    # and refreshes it only when it is about to expire.
+    def get_digikey_access_token(self):
+        with token_lock:
+            if not Digikey.token_is_valid(self):
+                with transaction.atomic():
+                    list(PluginSetting.objects.select_for_update().filter(plugin__key=PLUGIN_KEY, key='DIGIKEY_REFRESH_TOKEN'))
+                    Digikey.load_digikey_token(self)
+                    if not Digikey.token_is_valid(self):
+                        token_cache['misses'] = token_cache['misses'] + 1
+                        Instrumentation.count(self, 'cache_misses', {'cache': 'digikey_token'})
+                        return Digikey.refresh_digikey_access_token(self)
+            token_cache['hits'] = token_cache['hits'] + 1
+            Instrumentation.count(self, 'cache_hits', {'cache': 'digikey_token'})
+            return {'status_code': 200, 'message': 'success', 'access_token': token_cache['access_token']}
+
+    def token_is_valid(self):
+        return token_cache['access_token'] is not None and time.time() < token_cache['expires_at'] - TOKEN_MARGIN
+
+    # Takes the token that the last refresh of any process stored in the settings.
+    def load_digikey_token(self):
+        token_cache['access_token'] = self.get_setting('DIGIKEY_TOKEN') or None
+        try:
+            token_cache['expires_at'] = float(self.get_setting('DIGIKEY_TOKEN_EXPIRES'))
+        except (TypeError, ValueError):
+            token_cache['expires_at'] = 0
+
+    # The token for the headers. The setting is used when the cache is empty.
+    def get_access_token(self):
+        with token_lock:
+            access_token = token_cache['access_token']
+        if access_token is None:
+            access_token = self.get_setting('DIGIKEY_TOKEN')
+        return access_token
+
+    # Stores a new token pair from the OAuth answer in the settings and the cache.
+    def store_digikey_token(self, response_data):
+        expires_at = time.time() + int(response_data.get('expires_in', 0))
+        self.set_setting('DIGIKEY_TOKEN', response_data['access_token'])
+        self.set_setting('DIGIKEY_REFRESH_TOKEN', response_data['refresh_token'])
+        self.set_setting('DIGIKEY_TOKEN_EXPIRES', str(int(expires_at)))
+        token_cache['access_token'] = response_data['access_token']
+        token_cache['expires_at'] = expires_at
+
+    # Digikey rejected the token. The next call will refresh it. The stored expiry
+    # is reset too, unless another process has already stored a new token.
+    def invalidate_digikey_token(self):
+        with token_lock:
+            if token_cache['access_token'] is not None and self.get_setting('DIGIKEY_TOKEN') == token_cache['access_token']:
+                self.set_setting('DIGIKEY_TOKEN_EXPIRES', '0')
+            token_cache['expires_at'] = 0
+
+    def get_digikey_token_stats(self):
+        return {'hits': token_cache['hits'],
+                'misses': token_cache['misses'],
+                'valid_for': max(0, int(token_cache['expires_at'] - time.time())),
+                }
+
     def refresh_digikey_access_token(self):
 
         url = 'https://api.digikey.com/v1/oauth2/token'
@@ -254,7 +506,7 @@ class Digikey():
         header = {}
         token = {}
         response = Wrappers.post_request(self, url_data, url, headers=header)
-        response_json = response.json()
+        response_json = Wrappers.get_json(self, response)
 
         # On success there is no StatusCode, just in error case
         try:
@@ -264,11 +516,10 @@ class Digikey():
         except Exception:
             pass
         print('\033[32mToken refresh SUCCESS\033[0m')
-        response_data = response.json()
-        self.set_setting('DIGIKEY_TOKEN', response_data['access_token'])
-        self.set_setting('DIGIKEY_REFRESH_TOKEN', response_data['refresh_token'])
+        response_data = Wrappers.get_json(self, response)
+        Digikey.store_digikey_token(self, response_data)
         token['status_code'] = response.status_code
         token['message'] = 'success'
-        token['acces_token'] = response_data['access_token']
+        token['access_token'] = response_data['access_token']
         token['refresh_token'] = response_data['refresh_token']
         return (token)
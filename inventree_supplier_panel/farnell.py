@@ -1,69 +1,208 @@
 from inventree_supplier_panel.request_wrappers import Wrappers
+from inventree_supplier_panel.parallel_lookup import ParallelLookup
+
+from decimal import Decimal
+
+
+# ----------------------------------------------------------------------------
+# Farnell answers in the shop (region) that is sent with each request. The
+# answer has no currency, just the numbers. So the currency of the shop is a
+# setting too. The responseGroup selects how much Farnell sends. Lookups that
+# only need the prices, like the price refresh, use the small group. Everything
+# else uses the group from the settings, large by default. The part data cache
+# key contains shop, currency and group, see cache_settings in the registry.
+
+DEFAULT_STORE = 'de.farnell.com'
+DEFAULT_CURRENCY = 'EUR'
+DEFAULT_RESPONSE_GROUP = 'large'
+PRICE_RESPONSE_GROUP = 'small'
 
 
 class Farnell():
+
+    # Maximum number of part numbers in one search request
+    BATCH_SIZE = 20
+
     # --------------------------- get_farnell_partdata -----------------------------
     def get_farnell_partdata(self, sku, options):
+        return Farnell.get_farnell_partdata_many(self, [sku], options)[sku]
+
+    # --------------------------- get_farnell_partdata_many ------------------------
+    # Farnell accepts several part numbers separated by , in term=id:. The products
+    # in the answer are sorted back to the requested SKUs. The result is a dict with
+    # one part_data per SKU. With options 'prices' the small response group is used.
 
-        # This is OK for Germany. In other countries this might need to be changed.
-        # Farnell does not return the currency for the prices, justi the numbers.
-        # The currency depends on the selected shop.
-        store = 'de.farnell.com'
-        currency = 'EUR'
+    def get_farnell_partdata_many(self, skus, options):
+        store = self.get_setting('FARNELL_STORE') or DEFAULT_STORE
+        currency = self.get_setting('FARNELL_CURRENCY') or DEFAULT_CURRENCY
+        if options == 'prices':
+            response_group = PRICE_RESPONSE_GROUP
+        else:
+            response_group = self.get_setting('FARNELL_RESPONSE_GROUP') or DEFAULT_RESPONSE_GROUP
 
-        part_data = {}
+        all_part_data = {}
+        for i in range(0, len(skus), Farnell.BATCH_SIZE):
+            batch = skus[i:i + Farnell.BATCH_SIZE]
+            error_status, products = Farnell.search_farnell_parts(self, ','.join(batch), store, response_group)
+            for sku in batch:
+                part_data = {'error_status': error_status}
+                if error_status == 'OK':
+                    Farnell.select_farnell_part(self, sku, products, part_data, currency)
+                all_part_data[sku] = part_data
+        return all_part_data
+
+    # --------------------------- search_farnell_parts -----------------------------
+    # Sends the search request and checks the answer for errors. Returns the
+    # error status and the list of products.
+
+    def search_farnell_parts(self, part_numbers, store, response_group):
         access_key = self.get_setting('FARNELLSEARCHKEY')
         header = {'Content-type': 'application/json', 'Accept': 'application/json'}
         path = 'https://api.element14.com/catalog/products?'
-        path_string = path + 'term=id:' + sku + '&storeInfo.id=' + store + '&resultsSettings.responseGroup=large&callInfo.responseDataFormat=json&callinfo.apiKey=' + access_key
+        path_string = path + 'term=id:' + part_numbers + '&storeInfo.id=' + store + '&resultsSettings.responseGroup=' + response_group + '&callInfo.responseDataFormat=json&callinfo.apiKey=' + access_key
         response = Wrappers.get_request(self, path_string, header)
 
         # Try if a valid json has se been received. Otherwise return the content
         # of the response
         try:
-            response = response.json()
+            response = Wrappers.get_json(self, response)
         except Exception:
-            part_data['error_status'] = str(response.content)
-            return part_data
+            return str(response.content), []
 
         # print('Response: ', response)
         # If Farnell has problems with the request there will be an error key in the json
         try:
-            part_data['error_status'] = str(response['error'])
-            return part_data
+            return str(response['error']), []
         except Exception:
             pass
-        response = response['premierFarnellPartNumberReturn']
-
-        # Lets look if parts have been reported
+        # Other errors like a used up quota come without the result
+        try:
+            response = response['premierFarnellPartNumberReturn']
+        except Exception:
+            return str(response), []
         if response['numberOfResults'] == 0:
+            return 'OK', []
+        return 'OK', response['products']
+
+    # --------------------------- select_farnell_part ------------------------------
+    # Takes the product with the requested SKU from the answer.
+
+    def select_farnell_part(self, sku, products, part_data, currency):
+        for product in products:
+            if product['sku'] == sku:
+                break
+        else:
             part_data['error_status'] = f'Part with SKU "{sku}" not found in Farnell catalog!'
             return part_data
 
+        # An answer without prices is an error. An empty list would delete all
+        # price breaks of the part in the price refresh.
+        if 'prices' not in product:
+            part_data['error_status'] = f'Farnell sent no prices for SKU "{sku}"'
+            return part_data
+
         # If we are here, everything seems fine so far. Lets grab the data.
-        part_data['error_status'] = 'OK'
-        part_data['number_of_results'] = response['numberOfResults']
+        part_data['number_of_results'] = 1
         part_data['price_breaks'] = []
-        part_data['SKU'] = response['products'][0]['sku']
-        part_data['MPN'] = response['products'][0]['translatedManufacturerPartNumber']
+        part_data['SKU'] = product['sku']
+        part_data['MPN'] = product.get('translatedManufacturerPartNumber', '')
+        part_data['manufacturer'] = product.get('vendorName') or product.get('brandName', '')
         part_data['URL'] = 'https://www.element14.com/community/view-product.jspa?fsku=' + sku
-        part_data['lifecycle_status'] = response['products'][0]['productStatus']
+        part_data['lifecycle_status'] = product.get('productStatus', '')
         # the Farnell translatedMinimumOrderQuality is not a pack quantity as ist is used
         # in Inventree. It is just a minimum order quantity. The reported price is still
         # per piece. That is why we put this into the pack
-#        part_data['pack_quantity'] = str(response['products'][0]['translatedMinimumOrderQuality'])
+#        part_data['pack_quantity'] = str(product['translatedMinimumOrderQuality'])
         part_data['pack_quantity'] = '1'
-        part_data['description'] = response['products'][0]['displayName']
-        part_data['package'] = str(response['products'][0]['translatedMinimumOrderQuality']) + ' ' + response['products'][0]['unitOfMeasure']
-        for pb in response['products'][0]['prices']:
+        part_data['description'] = product.get('displayName', '')
+        part_data['package'] = str(product.get('translatedMinimumOrderQuality', '')) + ' ' + product.get('unitOfMeasure', '')
+        try:
+            part_data['moq'] = int(product['translatedMinimumOrderQuality'])
+        except Exception:
+            part_data['moq'] = 1
+        try:
+            part_data['stock'] = int(product['stock']['level'])
+        except Exception:
+            part_data['stock'] = 0
+        for pb in product['prices']:
             new_price = pb['cost']
             part_data['price_breaks'].append({'Quantity': pb['from'], 'Price': new_price, 'Currency': currency})
         return part_data
 
     # --------------------------- create_farnell_cart -------------------------
-    # This is just a dummy so far.
+    # Farnell has no cart API. The cart is built from the actual part data and
+    # is ordered with the quick paste export of the cart. The order reference is
+    # the cart key.
     def create_farnell_cart(self, order):
         cart_data = {}
-        cart_data['ID'] = ''
-        cart_data['error_status'] = 'Not supported yet'
+        cart_data['ID'] = order.reference
+        cart_data['error_status'] = 'OK'
         return (cart_data)
+
+    # --------------------------- update_farnell_cart -------------------------
+    # All SKUs of the order are looked up in batches and in parallel without the
+    # part data cache, so prices and stock are up to date. Lines with the same SKU
+    # are merged like in the Mouser cart.
+    def update_farnell_cart(self, order, cart_key):
+        lines = {}
+        for item in order.lines.select_related('part__part'):
+            if item.part.SKU in lines:
+                lines[item.part.SKU]['Quantity'] = lines[item.part.SKU]['Quantity'] + int(item.quantity)
+            else:
+                lines[item.part.SKU] = {'SKU': item.part.SKU,
+                                        'Quantity': int(item.quantity),
+                                        'IPN': item.part.part.IPN,
+                                        }
+        all_data = ParallelLookup.get_partdata_many(self, [(order.supplier.pk, sku, 'exact') for sku in lines], use_cache=False)
+
+        cart_items = []
+        merchandise_total = Decimal(0)
+        currency_code = self.get_setting('FARNELL_CURRENCY') or DEFAULT_CURRENCY
+        for line, part_data in zip(lines.values(), all_data):
+            cart_item = Farnell.get_farnell_cart_item(self, line, part_data)
+            merchandise_total = merchandise_total + Decimal(str(cart_item['ExtendedPrice']))
+            if part_data.get('price_breaks', []) != []:
+                currency_code = part_data['price_breaks'][0]['Currency']
+            cart_items.append(cart_item)
+
+        # When no line could be resolved, the search itself failed.
+        errors = [part_data['error_status'] for part_data in all_data if part_data['error_status'] != 'OK']
+        if all_data != [] and len(errors) == len(all_data):
+            return {'error_status': errors[0]}
+        return {'MerchandiseTotal': float(merchandise_total),
+                'CartItems': cart_items,
+                'cart_key': cart_key,
+                'currency_code': currency_code,
+                'error_status': 'OK',
+                }
+
+    # --------------------------- get_farnell_cart_item -----------------------
+    # The unit price is the price of the largest price break up to the quantity.
+    def get_farnell_cart_item(self, line, part_data):
+        cart_item = {'SKU': line['SKU'],
+                     'IPN': line['IPN'],
+                     'MPN': part_data.get('MPN', ''),
+                     'Manufacturer': part_data.get('manufacturer', ''),
+                     'Description': part_data.get('description', ''),
+                     'QuantityRequested': line['Quantity'],
+                     'QuantityAvailable': part_data.get('stock', 0),
+                     'UnitPrice': 0,
+                     'ExtendedPrice': 0,
+                     'Error': part_data.get('package', ''),
+                     }
+        if part_data['error_status'] != 'OK':
+            cart_item['Error'] = part_data['error_status']
+            cart_item['HasError'] = True
+            return cart_item
+        if line['Quantity'] < part_data['moq'] or part_data['price_breaks'] == []:
+            cart_item['Error'] = 'Minimum order quantity not reached'
+            cart_item['HasError'] = True
+            return cart_item
+        price_breaks = sorted(part_data['price_breaks'], key=lambda pb: pb['Quantity'])
+        unit_price = price_breaks[0]['Price']
+        for pb in price_breaks:
+            if pb['Quantity'] <= line['Quantity']:
+                unit_price = pb['Price']
+        cart_item['UnitPrice'] = unit_price
+        cart_item['ExtendedPrice'] = float(Decimal(str(unit_price)) * line['Quantity'])
+        return cart_item
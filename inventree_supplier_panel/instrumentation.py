@@ -0,0 +1,127 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# ----------------------------------------------------------------------------
+# Timings and counters of the hot paths. Each measurement goes into process
+# wide Prometheus style metrics and into the trace of the running operation.
+# A trace is started by the views and the cart transfer and collects the time
+# per stage (http, json, db, rate_limit_wait) and the counters like requests,
+# bytes and cache hits of this operation only. Worker threads join the trace of
+# the thread that started them with set_trace.
+# The metrics are per process. The cart transfer runs in the background worker,
+# so its metrics are in the worker process.
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+PREFIX = 'supplier_panel_'
+
+counters = {}
+histograms = {}
+metrics_lock = threading.Lock()
+local = threading.local()
+
+
+class Instrumentation():
+
+    # ------------------------------- traces ---------------------------------
+    def start_trace(self):
+        trace = {'started': time.perf_counter(), 'stages': {}, 'counters': {}}
+        local.trace = trace
+        return trace
+
+    # Returns the summary of the trace of this thread and ends it.
+    def stop_trace(self):
+        trace = getattr(local, 'trace', None)
+        local.trace = None
+        if trace is None:
+            return None
+        with metrics_lock:
+            stages = {}
+            for stage, data in trace['stages'].items():
+                stages[stage] = {'count': data['count'], 'seconds': round(data['seconds'], 4)}
+            return {'total_seconds': round(time.perf_counter() - trace['started'], 4),
+                    'stages': stages,
+                    'counters': dict(trace['counters']),
+                    }
+
+    def get_trace(self):
+        return getattr(local, 'trace', None)
+
+    def set_trace(self, trace):
+        local.trace = trace
+
+    # ------------------------------- measurements ---------------------------
+    def get_key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def get_trace_name(self, name, labels):
+        if labels == {}:
+            return name
+        return name + ':' + ','.join(str(value) for key, value in sorted(labels.items()))
+
+    def count(self, name, labels={}, value=1):
+        key = Instrumentation.get_key(self, name, labels)
+        trace = getattr(local, 'trace', None)
+        with metrics_lock:
+            counters[key] = counters.get(key, 0) + value
+            if trace is not None:
+                trace_name = Instrumentation.get_trace_name(self, name, labels)
+                trace['counters'][trace_name] = trace['counters'].get(trace_name, 0) + value
+
+    # Adds the duration of one stage to the histogram and to the trace.
+    def record(self, stage, seconds, labels={}):
+        key = Instrumentation.get_key(self, 'stage_seconds', dict(labels, stage=stage))
+        trace = getattr(local, 'trace', None)
+        with metrics_lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+                histograms[key] = histogram
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] = histogram['buckets'][i] + 1
+            histogram['count'] = histogram['count'] + 1
+            histogram['sum'] = histogram['sum'] + seconds
+            if trace is not None:
+                data = trace['stages'].setdefault(stage, {'count': 0, 'seconds': 0.0})
+                data['count'] = data['count'] + 1
+                data['seconds'] = data['seconds'] + seconds
+
+    @contextmanager
+    def timer(self, stage, labels={}):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Instrumentation.record(self, stage, time.perf_counter() - start, labels)
+
+    # ------------------------------- prometheus -----------------------------
+    # The metrics in the Prometheus text format.
+    def render_metrics(self):
+        lines = []
+        with metrics_lock:
+            names = sorted(set(name for name, labels in counters))
+            for name in names:
+                lines.append(f'# TYPE {PREFIX}{name}_total counter')
+                for (counter_name, labels), value in sorted(counters.items()):
+                    if counter_name == name:
+                        lines.append(f'{PREFIX}{name}_total{Instrumentation.format_labels(self, labels)} {value}')
+            if histograms != {}:
+                lines.append(f'# TYPE {PREFIX}stage_seconds histogram')
+            for (name, labels), histogram in sorted(histograms.items()):
+                for bound, value in zip(BUCKETS, histogram['buckets']):
+                    lines.append(f'{PREFIX}{name}_bucket{Instrumentation.format_labels(self, labels + (("le", str(bound)),))} {value}')
+                lines.append(f'{PREFIX}{name}_bucket{Instrumentation.format_labels(self, labels + (("le", "+Inf"),))} {histogram["count"]}')
+                lines.append(f'{PREFIX}{name}_sum{Instrumentation.format_labels(self, labels)} {round(histogram["sum"], 6)}')
+                lines.append(f'{PREFIX}{name}_count{Instrumentation.format_labels(self, labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def format_labels(self, labels):
+        if labels == ():
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def clear_metrics(self):
+        with metrics_lock:
+            counters.clear()
+            histograms.clear()
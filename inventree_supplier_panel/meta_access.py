@@ -1,6 +1,12 @@
 # Class to access the meta data field in InvenTree. The wrappers build
 # a dict with plugin name so that the data from different plugins does
-# not overlap
+# not overlap.
+# set_value locks the row and reads the metadata again before it writes only
+# the metadata field. So the changes that others made to the object while we
+# worked on an old instance, for example during a long cart transfer, are kept.
+
+from django.db import transaction
+
 
 class MetaAccess():
 
@@ -12,14 +18,16 @@ class MetaAccess():
         return (value)
 
     def set_value(self, inventree_object, key, value):
-        data = inventree_object.metadata
-        if data is None:
-            data = {}
-        if self.NAME in data:
-            app_data = data[self.NAME]
-            app_data.update({key: value})
-            data.update({self.NAME: app_data})
-        else:
-            data.update({self.NAME: {key: value}})
-        inventree_object.metadata = data
-        inventree_object.save()
+        with transaction.atomic():
+            locked = type(inventree_object).objects.select_for_update().get(pk=inventree_object.pk)
+            data = locked.metadata
+            if data is None:
+                data = {}
+            if self.NAME in data:
+                app_data = data[self.NAME]
+                app_data.update({key: value})
+                data.update({self.NAME: app_data})
+            else:
+                data.update({self.NAME: {key: value}})
+            inventree_object.metadata = data
+            inventree_object.save(update_fields=['metadata'])
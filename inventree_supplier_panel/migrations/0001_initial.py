@@ -0,0 +1,54 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('order', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('supplier', models.CharField(blank=True, max_length=100)),
+                ('cart_key', models.CharField(blank=True, max_length=250)),
+                ('cart_date', models.DateField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('currency_code', models.CharField(blank=True, max_length=3)),
+                ('merchandise_total', models.DecimalField(decimal_places=6, default=0, max_digits=19)),
+                ('line_count', models.PositiveIntegerField(default=0)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cart_snapshots', to='order.purchaseorder')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['order', 'cart_date'], name='supplier_cart_order_date_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='CartSnapshotLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('SKU', models.CharField(blank=True, max_length=250)),
+                ('IPN', models.CharField(blank=True, max_length=250)),
+                ('MPN', models.CharField(blank=True, max_length=250)),
+                ('manufacturer', models.CharField(blank=True, max_length=250)),
+                ('description', models.TextField(blank=True)),
+                ('quantity_requested', models.IntegerField(default=0)),
+                ('quantity_available', models.IntegerField(default=0)),
+                ('unit_price', models.DecimalField(decimal_places=6, default=0, max_digits=19)),
+                ('extended_price', models.DecimalField(decimal_places=6, default=0, max_digits=19)),
+                ('error', models.TextField(blank=True)),
+                ('has_error', models.BooleanField(default=False)),
+                ('snapshot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='inventree_supplier_panel.cartsnapshot')),
+            ],
+            options={
+                'ordering': ['position'],
+                'indexes': [models.Index(fields=['snapshot', 'position'], name='supplier_cartline_pos_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,338 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+
+# ----------------------------------------------------------------------------
+# Local stand in for the supplier APIs for tests and benchmarks. It answers the
+# Mouser search and cart, the Digikey OAuth, product and MyLists and the Farnell
+# catalog requests that the plugin sends. Every SKU exists with MPN = SKU, except
+# SKUs that start with UNKNOWN. Prices and stock are derived from the SKU, so the
+# answers are the same in every run.
+# latency is added to each request in seconds. error_rate is the part of the
+# requests that fail with 500. After rate_limit requests to one supplier, the
+# supplier answers like its quota is used up.
+# Usage:
+#     server = MockSuppliers(latency=0.05)
+#     Wrappers.set_url_override(self, 'api.mouser.com', server.start())
+#     ...
+#     server.stop()
+
+
+class MockSuppliers():
+
+    def __init__(self, latency=0, error_rate=0, rate_limit=None, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.counts = {'mouser': 0, 'digikey': 0, 'farnell': 0}
+        self.mouser_carts = {}
+        self.digikey_lists = {}
+        self.server = None
+        self.routes = [('POST', r'/api/v1\.0/search/partnumber', 'mouser', self.mouser_search),
+                       ('POST', r'/api/v001/cart/items/(insert|update)', 'mouser', self.mouser_cart_items),
+                       ('POST', r'/api/v001/cart/item/remove', 'mouser', self.mouser_cart_remove),
+                       ('GET', r'/api/v001/cart', 'mouser', self.mouser_cart),
+                       ('POST', r'/v1/oauth2/token', 'digikey', self.digikey_token),
+                       ('GET', r'/products/v4/search/([^/]+)/productdetails', 'digikey', self.digikey_product),
+                       ('GET', r'/mylists/v1/lists', 'digikey', self.digikey_lists_get),
+                       ('POST', r'/mylists/v1/lists', 'digikey', self.digikey_list_create),
+                       ('GET', r'/mylists/v1/lists/validate/([^/]+)', 'digikey', self.digikey_list_validate),
+                       ('POST', r'/mylists/v1/lists/([^/]+)/parts', 'digikey', self.digikey_list_add),
+                       ('GET', r'/mylists/v1/lists/([^/]+)/parts/?', 'digikey', self.digikey_list_parts),
+                       ('GET', r'/catalog/products', 'farnell', self.farnell_search),
+                       ]
+
+    # ------------------------------- start / stop ---------------------------
+    # Returns the base URL of the server.
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+        self.server.daemon_threads = True
+        self.server.suppliers = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # ------------------------------- handle ---------------------------------
+    # Returns status, body and headers for a request.
+    def handle(self, method, path, body):
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        for route_method, pattern, supplier, function in self.routes:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {'message': 'Not found'}, {}
+        with self.lock:
+            self.requests.append((method, url.path))
+            self.counts[supplier] = self.counts[supplier] + 1
+            count = self.counts[supplier]
+            failed = self.random.random() < self.error_rate
+        time.sleep(self.latency)
+        headers = {}
+        if self.rate_limit is not None:
+            remaining = max(0, self.rate_limit - count)
+            headers = {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(remaining)}
+            if count > self.rate_limit:
+                headers['Retry-After'] = '1'
+                if supplier == 'mouser':
+                    return 200, {'Errors': [{'Code': 'TooManyRequests', 'Message': None}], 'SearchResults': None}, headers
+                return 429, {'message': 'Too Many Requests'}, headers
+        if failed:
+            return 500, {'message': 'Injected error'}, headers
+        status, data = function(query, body, *[unquote(group) for group in match.groups()])
+        return status, data, headers
+
+    # ------------------------------- catalog --------------------------------
+    def get_part(self, sku):
+        if sku.startswith('UNKNOWN'):
+            return None
+        seed = zlib.crc32(sku.encode())
+        price = 0.1 + (seed % 1000) / 1000
+        return {'sku': sku,
+                'mpn': sku,
+                'stock': seed % 10000,
+                'moq': 1,
+                'price_breaks': [(1, round(price, 4)),
+                                 (10, round(price * 0.9, 4)),
+                                 (100, round(price * 0.75, 4)),
+                                 (1000, round(price * 0.6, 4)),
+                                 ],
+                }
+
+    def get_price(self, part, quantity):
+        unit_price = part['price_breaks'][0][1]
+        for break_quantity, price in part['price_breaks']:
+            if quantity >= break_quantity:
+                unit_price = price
+        return unit_price
+
+    # ------------------------------- Mouser ---------------------------------
+    def mouser_search(self, query, body):
+        parts = []
+        for sku in json.loads(body)['SearchByPartRequest']['mouserPartNumber'].split('|'):
+            part = self.get_part(sku)
+            if part is None:
+                continue
+            parts.append({'MouserPartNumber': sku,
+                          'ManufacturerPartNumber': part['mpn'],
+                          'Manufacturer': 'Mock',
+                          'Description': 'Mock part ' + sku,
+                          'ProductDetailUrl': 'https://www.mouser.com/ProductDetail/' + sku,
+                          'LifecycleStatus': None,
+                          'Min': str(part['moq']),
+                          'Mult': '1',
+                          'AvailabilityInStock': str(part['stock']),
+                          'ProductAttributes': [],
+                          'PriceBreaks': [{'Quantity': quantity, 'Price': f'{price:.4f} €'.replace('.', ','), 'Currency': 'EUR'}
+                                          for quantity, price in part['price_breaks']],
+                          })
+        return 200, {'Errors': [], 'SearchResults': {'NumberOfResult': len(parts), 'Parts': parts}}
+
+    def mouser_cart_items(self, query, body, action):
+        cart = json.loads(body)
+        cart_key = cart['CartKey']
+        with self.lock:
+            if cart_key == '':
+                cart_key = str(uuid.uuid4())
+            if cart_key not in self.mouser_carts:
+                if action == 'update':
+                    return 200, {'Errors': [{'Code': 'Invalid', 'Message': 'Invalid cart key'}]}
+                self.mouser_carts[cart_key] = {}
+            items = self.mouser_carts[cart_key]
+            for item in cart['CartItems']:
+                items[item['MouserPartNumber']] = {'Quantity': item['Quantity'], 'IPN': item['CustomerPartNumber']}
+        return 200, self.mouser_cart_answer(cart_key)
+
+    def mouser_cart_remove(self, query, body):
+        cart_key = query['cartKey'][0]
+        with self.lock:
+            if cart_key not in self.mouser_carts:
+                return 200, {'Errors': [{'Code': 'Invalid', 'Message': 'Invalid cart key'}]}
+            self.mouser_carts[cart_key].pop(query['mouserPartNumber'][0], None)
+        return 200, self.mouser_cart_answer(cart_key)
+
+    def mouser_cart(self, query, body):
+        cart_key = query['cartKey'][0]
+        if cart_key not in self.mouser_carts:
+            return 200, {'Errors': [{'Code': 'Invalid', 'Message': 'Invalid cart key'}]}
+        return 200, self.mouser_cart_answer(cart_key)
+
+    def mouser_cart_answer(self, cart_key):
+        cart_items = []
+        total = 0
+        for sku, item in list(self.mouser_carts[cart_key].items()):
+            part = self.get_part(sku)
+            if part is None:
+                cart_items.append({'MouserPartNumber': sku,
+                                   'CartItemCustPartNumber': item['IPN'],
+                                   'Quantity': item['Quantity'],
+                                   'MouserATS': 0,
+                                   'UnitPrice': 0,
+                                   'ExtendedPrice': 0,
+                                   'Errors': [{'Message': 'Invalid part number'}],
+                                   })
+                continue
+            unit_price = self.get_price(part, item['Quantity'])
+            total = total + unit_price * item['Quantity']
+            cart_items.append({'MouserPartNumber': sku,
+                               'CartItemCustPartNumber': item['IPN'],
+                               'Manufacturer': 'Mock',
+                               'MfrPartNumber': part['mpn'],
+                               'Description': 'Mock part ' + sku,
+                               'Quantity': item['Quantity'],
+                               'MouserATS': part['stock'],
+                               'UnitPrice': unit_price,
+                               'ExtendedPrice': round(unit_price * item['Quantity'], 4),
+                               'PackagingChoice': '',
+                               'Errors': [],
+                               })
+        return {'Errors': [],
+                'CartKey': cart_key,
+                'CurrencyCode': 'EUR',
+                'MerchandiseTotal': round(total, 4),
+                'CartItems': cart_items,
+                }
+
+    # ------------------------------- Digikey --------------------------------
+    def digikey_token(self, query, body):
+        return 200, {'access_token': str(uuid.uuid4()), 'refresh_token': str(uuid.uuid4()), 'expires_in': 1800}
+
+    def digikey_product(self, query, body, sku):
+        part = self.get_part(sku)
+        if part is None:
+            return 404, {'status': 404, 'title': 'Not found', 'detail': ' Product ' + sku + ' not found'}
+        return 200, {'Product': {'ManufacturerProductNumber': part['mpn'],
+                                 'ProductUrl': 'https://www.digikey.com/en/products/detail/' + sku,
+                                 'ProductStatus': {'Status': 'Active'},
+                                 'Description': {'DetailedDescription': 'Mock part ' + sku},
+                                 'ProductVariations': [{'DigiKeyProductNumber': sku,
+                                                        'PackageType': {'Name': 'Cut Tape (CT)'},
+                                                        'MinimumOrderQuantity': part['moq'],
+                                                        'QuantityAvailableforPackageType': part['stock'],
+                                                        'StandardPricing': [{'BreakQuantity': quantity, 'UnitPrice': price}
+                                                                            for quantity, price in part['price_breaks']],
+                                                        }],
+                                 },
+                     'SearchLocaleUsed': {'Currency': 'EUR'},
+                     }
+
+    def digikey_lists_get(self, query, body):
+        with self.lock:
+            return 200, [{'Id': list_id, 'ListName': data['name']} for list_id, data in self.digikey_lists.items()]
+
+    def digikey_list_create(self, query, body):
+        name = json.loads(body)['ListName']
+        with self.lock:
+            list_id = str(uuid.uuid4())
+            self.digikey_lists[list_id] = {'name': name, 'parts': []}
+        return 200, list_id
+
+    def digikey_list_validate(self, query, body, name):
+        with self.lock:
+            used = any(data['name'] == name for data in self.digikey_lists.values())
+        return 200, not used
+
+    def digikey_list_add(self, query, body, list_id):
+        with self.lock:
+            if list_id not in self.digikey_lists:
+                return 404, {'status': 404, 'title': 'Not found', 'detail': 'List not found'}
+            self.digikey_lists[list_id]['parts'].extend(json.loads(body))
+        return 200, {}
+
+    def digikey_list_parts(self, query, body, list_id):
+        if list_id not in self.digikey_lists:
+            return 404, {'status': 404, 'title': 'Not found', 'detail': 'List not found'}
+        parts_list = []
+        for item in self.digikey_lists[list_id]['parts']:
+            sku = item['RequestedPartNumber']
+            quantity = item['Quantities'][0]['Quantity']
+            part = self.get_part(sku)
+            if part is None:
+                parts_list.append({'DigiKeyPartNumber': '',
+                                   'RequestedPartNumber': sku,
+                                   'CustomerReference': item['CustomerReference'],
+                                   'QuantityAvailable': 0,
+                                   'Quantities': [{'QuantityRequested': quantity, 'PackOptions': []}],
+                                   })
+                continue
+            unit_price = self.get_price(part, quantity)
+            parts_list.append({'DigiKeyPartNumber': sku,
+                               'RequestedPartNumber': sku,
+                               'CustomerReference': item['CustomerReference'],
+                               'ManufacturerPartNumber': part['mpn'],
+                               'Manufacturer': 'Mock',
+                               'Description': 'Mock part ' + sku,
+                               'QuantityAvailable': part['stock'],
+                               'Quantities': [{'QuantityRequested': quantity,
+                                               'PackOptions': [{'DigiKeyPartNumber': sku,
+                                                                'CalculatedUnitPrice': unit_price,
+                                                                'ExtendedPrice': round(unit_price * quantity, 4),
+                                                                'MinimumOrderQuantity': part['moq'],
+                                                                'PackType': 'CT',
+                                                                }]}],
+                               })
+        return 200, {'PartsList': parts_list}
+
+    # ------------------------------- Farnell --------------------------------
+    def farnell_search(self, query, body):
+        products = []
+        for sku in query['term'][0].split(':', 1)[1].split(','):
+            part = self.get_part(sku)
+            if part is None:
+                continue
+            prices = []
+            for i, (quantity, price) in enumerate(part['price_breaks']):
+                to = part['price_breaks'][i + 1][0] - 1 if i + 1 < len(part['price_breaks']) else 999999999
+                prices.append({'from': quantity, 'to': to, 'cost': price})
+            products.append({'sku': sku,
+                             'displayName': 'Mock part ' + sku,
+                             'translatedManufacturerPartNumber': part['mpn'],
+                             'translatedMinimumOrderQuality': part['moq'],
+                             'unitOfMeasure': 'EACH',
+                             'productStatus': 'STOCKED',
+                             'stock': {'level': part['stock']},
+                             'prices': prices,
+                             })
+        if products == []:
+            return 200, {'premierFarnellPartNumberReturn': {'numberOfResults': 0}}
+        return 200, {'premierFarnellPartNumberReturn': {'numberOfResults': len(products), 'products': products}}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # noqa: N802
+        self.answer('GET')
+
+    def do_POST(self):  # noqa: N802
+        self.answer('POST')
+
+    def answer(self, method):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        status, data, headers = self.server.suppliers.handle(method, self.path, body)
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,49 @@
+from django.db import models
+
+# ----------------------------------------------------------------------------
+# Snapshots of the transferred carts. Each transfer creates one CartSnapshot
+# with one CartSnapshotLine per cart item. Older snapshots of an order are
+# kept as history. The order metadata holds only a pointer to the latest
+# snapshot, so the PO row stays small and cheap to save.
+
+
+class CartSnapshot(models.Model):
+
+    order = models.ForeignKey('order.PurchaseOrder', on_delete=models.CASCADE, related_name='cart_snapshots')
+    supplier = models.CharField(max_length=100, blank=True)
+    cart_key = models.CharField(max_length=250, blank=True)
+    cart_date = models.DateField()
+    created = models.DateTimeField(auto_now_add=True)
+    currency_code = models.CharField(max_length=3, blank=True)
+    merchandise_total = models.DecimalField(max_digits=19, decimal_places=6, default=0)
+    line_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['order', 'cart_date'], name='supplier_cart_order_date_idx')]
+
+    def __str__(self):
+        return f'{self.order_id} {self.cart_date} {self.cart_key}'
+
+
+class CartSnapshotLine(models.Model):
+
+    snapshot = models.ForeignKey(CartSnapshot, on_delete=models.CASCADE, related_name='lines')
+    position = models.PositiveIntegerField()
+    SKU = models.CharField(max_length=250, blank=True)
+    IPN = models.CharField(max_length=250, blank=True)
+    MPN = models.CharField(max_length=250, blank=True)
+    manufacturer = models.CharField(max_length=250, blank=True)
+    description = models.TextField(blank=True)
+    quantity_requested = models.IntegerField(default=0)
+    quantity_available = models.IntegerField(default=0)
+    unit_price = models.DecimalField(max_digits=19, decimal_places=6, default=0)
+    extended_price = models.DecimalField(max_digits=19, decimal_places=6, default=0)
+    error = models.TextField(blank=True)
+    has_error = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ['position']
+        indexes = [models.Index(fields=['snapshot', 'position'], name='supplier_cartline_pos_idx')]
+
+    def __str__(self):
+        return f'{self.snapshot_id} {self.position} {self.SKU}'
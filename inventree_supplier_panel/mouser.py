@@ -46,19 +46,46 @@ If you created more than 1000 requests within 24 hours:
            ], 'SearchResults': None}
 
 """
-from common.models import InvenTreeSetting
-
+from inventree_supplier_panel.settings_cache import SettingsCache
 from inventree_supplier_panel.request_wrappers import Wrappers
-import re
+from inventree_supplier_panel.cart_snapshot import CartSnapshots
+from inventree_supplier_panel.price_parser import PriceParser
+from urllib.parse import quote
 import json
 
 
 class Mouser():
+
+    # Maximum number of part numbers in one search request
+    BATCH_SIZE = 10
+
     # --------------------------- get_mouser_partdata -----------------------------
     def get_mouser_partdata(self, sku, options):
+        return Mouser.get_mouser_partdata_many(self, [sku], options)[sku]
+
+    # --------------------------- get_mouser_partdata_many ------------------------
+    # Mouser accepts up to BATCH_SIZE part numbers separated by | in one search
+    # request. The answer is a list of parts that we sort back to the requested SKUs.
+    # The result is a dict with one part_data per SKU.
 
-        part_data = {}
-        part = {"SearchByPartRequest": {"mouserPartNumber": sku,
+    def get_mouser_partdata_many(self, skus, options):
+        all_part_data = {}
+        for i in range(0, len(skus), Mouser.BATCH_SIZE):
+            batch = skus[i:i + Mouser.BATCH_SIZE]
+            error_status, parts = Mouser.search_mouser_parts(self, '|'.join(batch), options)
+            for sku in batch:
+                part_data = {'error_status': error_status}
+                if error_status == 'OK':
+                    Mouser.select_mouser_part(self, sku, parts, part_data)
+                all_part_data[sku] = part_data
+        return all_part_data
+
+    # --------------------------- search_mouser_parts -----------------------------
+    # Sends the search request and checks the answer for errors. Returns the
+    # error status and the list of parts.
+
+    def search_mouser_parts(self, part_numbers, options):
+        part = {"SearchByPartRequest": {"mouserPartNumber": part_numbers,
                                         "partSearchOptions": options,
                                         }
                 }
@@ -66,18 +93,16 @@ class Mouser():
         header = {'Content-type': 'application/json', 'Accept': 'application/json'}
         response = Wrappers.post_request(self, json.dumps(part), url, header)
         try:
-            response = response.json()
+            response = Wrappers.get_json(self, response)
         except Exception:
-            part_data['error_status'] = response
-            return part_data
+            return str(response.content), []
 
 #        print(response)
         # If we are here, Mouser responded. Lets look for errors. Some
         # errors do not come in the Errors array, but in a Message.
         # Lets check those first
         try:
-            part_data['error_status'] = response['Message']
-            return part_data
+            return response['Message'], []
         except Exception:
             pass
 
@@ -85,31 +110,29 @@ class Mouser():
         # and the rest.
         if response['Errors'] != []:
             if response['Errors'][0]['Code'] == 'InvalidCharacters':
-                part_data['error_status'] = 'InvalidCharacters'
+                return 'InvalidCharacters', []
             elif response['Errors'][0]['Code'] == 'Invalid':
-                part_data['error_status'] = 'InvalidAuthorization'
+                return 'InvalidAuthorization', []
             elif response['Errors'][0]['Code'] == 'TooManyRequests':
-                part_data['error_status'] = 'TooManyRequests'
+                Wrappers.report_rate_limit(self, url)
+                return 'TooManyRequests', []
             else:
-                part_data['error_status'] = response['Errors'][0]['Code']
-            return part_data
+                return response['Errors'][0]['Code'], []
 
         # If we came here, no errors have been reported and there sould be results.
-        number_of_results = int(response['SearchResults']['NumberOfResult'])
-        if number_of_results == 0:
-            part_data['error_status'] = 'OK'
-            part_data['number_of_results'] = number_of_results
-            return part_data
-
-        # Here least one result has been reported
-        part_data['error_status'] = 'OK'
-        number_of_results = 0
+        if int(response['SearchResults']['NumberOfResult']) == 0:
+            return 'OK', []
+        return 'OK', response['SearchResults']['Parts']
 
-        # Sometimes Mouser reports parts with different SKU even when exace is set
-        # Lest filter those
-        for pd in response['SearchResults']['Parts']:
+    # --------------------------- select_mouser_part ------------------------------
+    # Sometimes Mouser reports parts with different SKU even when exact is set.
+    # In a batch all parts are in one list anyway. So we take only the parts
+    # with the requested SKU.
+
+    def select_mouser_part(self, sku, parts, part_data):
+        number_of_results = 0
+        for pd in parts:
             if pd['MouserPartNumber'] == sku:
-                part_data['price_breaks'] = []
                 part_data['SKU'] = pd['MouserPartNumber']
                 part_data['MPN'] = pd['ManufacturerPartNumber']
                 part_data['URL'] = pd['ProductDetailUrl']
@@ -117,12 +140,20 @@ class Mouser():
                 part_data['pack_quantity'] = pd['Mult']
                 part_data['description'] = pd['Description']
                 part_data['package'] = Mouser.get_mouser_package(self, pd)
-                for pb in pd['PriceBreaks']:
-                    new_price = Mouser.reformat_mouser_price(self, pb['Price'])
-                    part_data['price_breaks'].append({'Quantity': pb['Quantity'], 'Price': new_price, 'Currency': pb['Currency']})
+                try:
+                    part_data['stock'] = int(pd['AvailabilityInStock'])
+                except Exception:
+                    part_data['stock'] = 0
+                try:
+                    part_data['moq'] = int(pd['Min'])
+                except Exception:
+                    part_data['moq'] = 1
+                try:
+                    part_data['mult'] = int(pd['Mult'])
+                except Exception:
+                    part_data['mult'] = 1
+                part_data['price_breaks'] = PriceParser.parse_price_breaks(self, pd['PriceBreaks'], float)
                 number_of_results = number_of_results + 1
-            else:
-                print('SKU does not match')
         part_data['number_of_results'] = number_of_results
         return part_data
 
@@ -145,59 +176,121 @@ class Mouser():
 
     # --------------------------- reformat_mouser_price --------------------------
     # We need a Mouser specific modification to the price answer because they put
-    # funny things inside like an EURO sign and they use , instead of .
-
-    def reformat_mouser_price(self, price):
-        price = price.replace('.', '')
-        price = price.replace(',', '.')
-        non_decimal = re.compile(r'[^\d.]+')
-        price = non_decimal.sub('', price)
-        if price == '':
-            price = 0
-        else:
-            price = float(price)
-        return price
+    # funny things inside like an EURO sign and they use , instead of . in the
+    # European shops. The work is done in PriceParser. The part data is stored
+    # as json, so the price is a float here.
+
+    def reformat_mouser_price(self, price, currency=None):
+        return float(PriceParser.parse_price(self, price, currency))
 
     # ------------------------ create_cart -------------------------------------------
-    # For Mouser this is just a dummy. We do not create a cart ID so far. It is
-    # automatically created by Mouser during item insertion. The return values are
-    # only for error handling.
+    # Mouser creates the cart key during the first item insertion. If the order
+    # was transferred before, we reuse the key of the latest cart snapshot. The
+    # return values are only for error handling.
 
     def create_mouser_cart(self, order):
         cart_data = {}
         cart_data['ID'] = ''
+        snapshot = CartSnapshots.get_snapshot(self, order)
+        if snapshot is not None:
+            cart_data['ID'] = snapshot.cart_key
         cart_data['error_status'] = 'OK'
         return (cart_data)
 
     # ------------------------ update_cart ----------------------------------
-    # Actually we send an empty CartKey. So Mouser creates a new key each time
-    # the button is pressed. This should be improved in future. It is mandatory
-    # to send a county code. The code is dreived from the Inventree currency setting.
-    # This might not always fit.
+    # Without a cart key all lines are inserted and Mouser creates a new cart.
+    # With the key of the last transfer only the changes since then are sent:
+    # new lines are inserted, changed lines are updated and deleted lines are
+    # removed. The lines of the last transfer come from the latest cart snapshot,
+    # so the order metadata only has the pointer to it. If the incremental
+    # update fails, for example because the cart was ordered in the meantime, a
+    # new cart is created. It is mandatory to send a county code. The code is
+    # dreived from the Inventree currency setting. This might not always fit.
 
     def update_mouser_cart(self, order, cart_key):
-        country_code = self.COUNTRY_CODES[InvenTreeSetting.get_setting('INVENTREE_DEFAULT_CURRENCY')]
-        cart_items = []
-        shopping_cart = {}
+        country_code = self.COUNTRY_CODES[SettingsCache.get_global_setting(self, 'INVENTREE_DEFAULT_CURRENCY')]
+        lines = {}
+        for item in order.lines.select_related('part__part'):
+            if item.part.SKU in lines:
+                lines[item.part.SKU]['Quantity'] = lines[item.part.SKU]['Quantity'] + int(item.quantity)
+            else:
+                lines[item.part.SKU] = {'MouserPartNumber': item.part.SKU,
+                                        'Quantity': int(item.quantity),
+                                        'CustomerPartNumber': item.part.part.IPN or ''
+                                        }
+
+        shopping_cart = None
+        snapshot = CartSnapshots.get_snapshot(self, order)
+        if cart_key != '' and snapshot is not None and snapshot.cart_key == cart_key:
+            shopping_cart = Mouser.diff_mouser_cart(self, cart_key, Mouser.get_last_mouser_lines(self, snapshot), lines, country_code)
+        if shopping_cart is None or shopping_cart['error_status'] != 'OK':
+            shopping_cart = Mouser.send_mouser_cart(self, 'insert', '', list(lines.values()), country_code)
+            shopping_cart['changes'] = {'inserted': len(lines), 'updated': 0, 'removed': 0}
+        return (shopping_cart)
+
+    # The lines of the cart in the snapshot in the format of update_mouser_cart
+    def get_last_mouser_lines(self, snapshot):
+        lines = {}
+        for sku, quantity, ipn in snapshot.lines.values_list('SKU', 'quantity_requested', 'IPN'):
+            lines[sku] = {'MouserPartNumber': sku,
+                          'Quantity': quantity,
+                          'CustomerPartNumber': ipn,
+                          }
+        return lines
+
+    # ------------------------ diff_mouser_cart -----------------------------
+    # Sends only the differences between the last transfer and the actual lines.
+    # Returns the cart after the last change.
+
+    def diff_mouser_cart(self, cart_key, last_lines, lines, country_code):
+        inserted = [line for sku, line in lines.items() if sku not in last_lines]
+        updated = [line for sku, line in lines.items() if sku in last_lines and last_lines[sku] != line]
+        removed = [sku for sku in last_lines if sku not in lines]
+
+        shopping_cart = None
+        if inserted != []:
+            shopping_cart = Mouser.send_mouser_cart(self, 'insert', cart_key, inserted, country_code)
+        if updated != [] and (shopping_cart is None or shopping_cart['error_status'] == 'OK'):
+            shopping_cart = Mouser.send_mouser_cart(self, 'update', cart_key, updated, country_code)
+        for sku in removed:
+            if shopping_cart is not None and shopping_cart['error_status'] != 'OK':
+                break
+            url = 'https://api.mouser.com/api/v001/cart/item/remove?apiKey=' + self.get_setting('MOUSERCARTKEY') + '&cartKey=' + cart_key + '&mouserPartNumber=' + quote(sku) + '&countryCode=' + country_code
+            header = {'Content-type': 'application/json', 'Accept': 'application/json'}
+            shopping_cart = Mouser.read_mouser_cart(self, Wrappers.post_request(self, '', url, header))
 
-        for item in order.lines.all():
-            cart_items.append({'MouserPartNumber': item.part.SKU,
-                               'Quantity': int(item.quantity),
-                               'CustomerPartNumber': item.part.part.IPN
-                               })
+        # Nothing changed. We just read the cart for the actual prices.
+        if shopping_cart is None:
+            url = 'https://api.mouser.com/api/v001/cart?apiKey=' + self.get_setting('MOUSERCARTKEY') + '&cartKey=' + cart_key + '&countryCode=' + country_code
+            header = {'Content-type': 'application/json', 'Accept': 'application/json'}
+            shopping_cart = Mouser.read_mouser_cart(self, Wrappers.get_request(self, url, header))
+        shopping_cart['changes'] = {'inserted': len(inserted), 'updated': len(updated), 'removed': len(removed)}
+        return (shopping_cart)
+
+    # ------------------------ send_mouser_cart -----------------------------
+    # action is insert or update. Both take the same list of items.
+
+    def send_mouser_cart(self, action, cart_key, cart_items, country_code):
         cart = {
             "CartKey": cart_key,
             "CartItems": cart_items
         }
-        url = 'https://api.mouser.com/api/v001/cart/items/insert?apiKey=' + self.get_setting('MOUSERCARTKEY') + '&countryCode=' + country_code
+        url = 'https://api.mouser.com/api/v001/cart/items/' + action + '?apiKey=' + self.get_setting('MOUSERCARTKEY') + '&countryCode=' + country_code
         header = {'Content-type': 'application/json', 'Accept': 'application/json'}
         response = Wrappers.post_request(self, json.dumps(cart), url, header)
+        return (Mouser.read_mouser_cart(self, response))
+
+    # ------------------------ read_mouser_cart -----------------------------
+    # All cart requests answer with the complete cart.
+
+    def read_mouser_cart(self, response):
+        shopping_cart = {}
 
         # Return with error if response was not OK
         if response.status_code != 200:
             shopping_cart['error_status'] = str(response.content)
             return (shopping_cart)
-        response = response.json()
+        response = Wrappers.get_json(self, response)
         if response['Errors'] != []:
             shopping_cart['error_status'] = response['Errors'][0]['Message']
             return (shopping_cart)
@@ -222,7 +315,8 @@ class Mouser():
                                    'QuantityAvailable': p['MouserATS'],
                                    'UnitPrice': p['UnitPrice'],
                                    'ExtendedPrice': p['ExtendedPrice'],
-                                   'Error': p['Errors'][0]['Message']
+                                   'Error': p['Errors'][0]['Message'],
+                                   'HasError': True,
                                    })
 
         # Here we get the currency_code from the Mouser response
@@ -0,0 +1,100 @@
+from django.db import connection
+
+from inventree_supplier_panel.instrumentation import Instrumentation
+from inventree_supplier_panel.request_wrappers import TooManyRequests
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+# ----------------------------------------------------------------------------
+# Engine for many supplier lookups at once. The lookups run in a thread pool,
+# so the total time depends on the slowest requests and not on the number of
+# parts. Each supplier has its own limit of parallel requests. The limits are
+# shared by all requests in this process.
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_SUPPLIER_CONCURRENCY = 4
+
+semaphores = {}
+semaphores_lock = threading.Lock()
+
+
+class ParallelLookup():
+
+    # ------------------------------- get_semaphore --------------------------
+    # A new semaphore is created when the limit in the settings changes.
+    def get_semaphore(self, supplier, limit):
+        with semaphores_lock:
+            semaphore = semaphores.get((supplier, limit))
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(limit)
+                semaphores[(supplier, limit)] = semaphore
+        return semaphore
+
+    # ------------------------------- get_partdata_many ----------------------
+    # lookups is a list of (supplier, sku, options) tuples. The result is a list
+    # of part_data dicts in the same order. Duplicate lookups are done only once.
+    def get_partdata_many(self, lookups, use_cache=True):
+        try:
+            max_workers = int(self.get_setting('MAX_WORKERS'))
+        except Exception:
+            max_workers = DEFAULT_MAX_WORKERS
+        try:
+            limit = int(self.get_setting('SUPPLIER_CONCURRENCY'))
+        except Exception:
+            limit = DEFAULT_SUPPLIER_CONCURRENCY
+
+        tasks = ParallelLookup.get_tasks(self, list(dict.fromkeys(lookups)))
+        if tasks == []:
+            return []
+        results = {}
+        trace = Instrumentation.get_trace(self)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as executor:
+            task_results = executor.map(lambda task: ParallelLookup.lookup_task(self, task, limit, use_cache, trace), tasks)
+            for task, part_data in zip(tasks, task_results):
+                results.update(zip(task, part_data))
+        return [results[lookup] for lookup in lookups]
+
+    # ------------------------------- get_tasks ------------------------------
+    # Splits the lookups into tasks for the worker threads. Suppliers that can
+    # search many SKUs in one request get tasks with up to batch size lookups.
+    # All others get one task per lookup.
+    def get_tasks(self, lookups):
+        batch_sizes = {}
+        batches = {}
+        tasks = []
+        for lookup in lookups:
+            supplier, sku, options = lookup
+            if supplier not in batch_sizes:
+                batch_sizes[supplier] = self.get_batch_size(supplier)
+            if batch_sizes[supplier] > 1:
+                batches.setdefault((supplier, options), []).append(lookup)
+            else:
+                tasks.append([lookup])
+        for (supplier, options), batch in batches.items():
+            size = batch_sizes[supplier]
+            for i in range(0, len(batch), size):
+                tasks.append(batch[i:i + size])
+        return tasks
+
+    # ------------------------------- lookup_task ----------------------------
+    # Runs in a worker thread. All lookups of a task have the same supplier and
+    # options. A connection error or a blocked host is reported in the error status. The thread
+    # joins the trace of the caller. The database connection of the thread is
+    # closed at the end.
+    def lookup_task(self, task, limit, use_cache, trace=None):
+        supplier, sku, options = task[0]
+        Instrumentation.set_trace(self, trace)
+        try:
+            with ParallelLookup.get_semaphore(self, supplier, limit):
+                if len(task) == 1:
+                    return [self.get_partdata(supplier, sku, options, use_cache=use_cache)]
+                all_part_data = self.get_partdata_batch(supplier, [lookup[1] for lookup in task], options, use_cache=use_cache)
+                return [all_part_data[lookup[1]] for lookup in task]
+        except TooManyRequests:
+            return [{'error_status': 'TooManyRequests'} for lookup in task]
+        except ConnectionError:
+            return [{'error_status': 'Connection to supplier failed'} for lookup in task]
+        finally:
+            Instrumentation.set_trace(self, None)
+            connection.close()
@@ -0,0 +1,144 @@
+from inventree_supplier_panel.settings_cache import SettingsCache
+from inventree_supplier_panel.supplier_registry import SupplierRegistry
+from inventree_supplier_panel.instrumentation import Instrumentation
+
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+
+# ----------------------------------------------------------------------------
+# Cache for the part data answers of the suppliers. The key contains everything
+# that changes the answer: supplier, SKU, search options, currency and the
+# cache_settings of the supplier like the Mouser language or the Farnell shop.
+# Entries expire after PARTDATA_CACHE_TTL seconds. The cache holds at most
+# PARTDATA_CACHE_SIZE entries and drops the least recently used ones.
+# The in memory cache is per process. If PARTDATA_CACHE_FILE is set, the entries
+# are also stored in a sqlite file, so that they survive restarts and are shared
+# between the server processes. Only successful answers are cached.
+
+DEFAULT_TTL = 86400
+DEFAULT_SIZE = 5000
+
+memory_cache = OrderedDict()
+cache_lock = threading.Lock()
+cache_stats = {'hits': 0,
+               'misses': 0,
+               }
+
+
+class PartDataCache():
+
+    def get_cache_settings(self):
+        try:
+            ttl = int(self.get_setting('PARTDATA_CACHE_TTL'))
+        except Exception:
+            ttl = DEFAULT_TTL
+        try:
+            size = int(self.get_setting('PARTDATA_CACHE_SIZE'))
+        except Exception:
+            size = DEFAULT_SIZE
+        return ttl, size, self.get_setting('PARTDATA_CACHE_FILE')
+
+    def get_cache_key(self, supplier, sku, options):
+        currency = SettingsCache.get_global_setting(self, 'INVENTREE_DEFAULT_CURRENCY')
+        entry = SupplierRegistry.get_supplier(self, supplier)
+        settings = []
+        if entry is not None:
+            settings = [self.get_setting(key) for key in entry.get('cache_settings', ())]
+        return json.dumps([supplier, sku.strip(), options, currency, settings])
+
+    # ------------------------------- get_cached_partdata --------------------
+    # Returns a copy of the cached part data or None.
+    def get_cached_partdata(self, supplier, sku, options):
+        ttl, size, path = PartDataCache.get_cache_settings(self)
+        if ttl <= 0:
+            return None
+        key = PartDataCache.get_cache_key(self, supplier, sku, options)
+        now = time.time()
+        with cache_lock:
+            entry = memory_cache.get(key)
+            if entry is not None and entry[0] > now:
+                memory_cache.move_to_end(key)
+                cache_stats['hits'] = cache_stats['hits'] + 1
+                Instrumentation.count(self, 'cache_hits', {'cache': 'partdata'})
+                return json.loads(entry[1])
+        if path:
+            entry = PartDataCache.read_file_entry(self, path, key, now)
+            if entry is not None:
+                PartDataCache.put_memory_entry(self, key, entry, size)
+                with cache_lock:
+                    cache_stats['hits'] = cache_stats['hits'] + 1
+                Instrumentation.count(self, 'cache_hits', {'cache': 'partdata_file'})
+                return json.loads(entry[1])
+        with cache_lock:
+            cache_stats['misses'] = cache_stats['misses'] + 1
+        Instrumentation.count(self, 'cache_misses', {'cache': 'partdata'})
+        return None
+
+    # ------------------------------- store_partdata -------------------------
+    def store_partdata(self, supplier, sku, options, part_data):
+        ttl, size, path = PartDataCache.get_cache_settings(self)
+        if ttl <= 0 or part_data.get('error_status') != 'OK':
+            return
+        key = PartDataCache.get_cache_key(self, supplier, sku, options)
+        entry = (time.time() + ttl, json.dumps(part_data, default=str))
+        PartDataCache.put_memory_entry(self, key, entry, size)
+        if path:
+            PartDataCache.write_file_entry(self, path, key, entry, size)
+
+    def put_memory_entry(self, key, entry, size):
+        with cache_lock:
+            memory_cache[key] = entry
+            memory_cache.move_to_end(key)
+            while len(memory_cache) > size:
+                memory_cache.popitem(last=False)
+
+    def clear_cache(self):
+        with cache_lock:
+            memory_cache.clear()
+        path = self.get_setting('PARTDATA_CACHE_FILE')
+        if path:
+            db = PartDataCache.open_file(self, path)
+            try:
+                with db:
+                    db.execute('DELETE FROM partdata')
+            finally:
+                db.close()
+
+    def get_cache_stats(self):
+        with cache_lock:
+            return {'hits': cache_stats['hits'],
+                    'misses': cache_stats['misses'],
+                    'entries': len(memory_cache),
+                    }
+
+    # ------------------------------- file backing ---------------------------
+    def open_file(self, path):
+        db = sqlite3.connect(path, timeout=5)
+        db.execute('CREATE TABLE IF NOT EXISTS partdata (key TEXT PRIMARY KEY, expires REAL, accessed REAL, data TEXT)')
+        return db
+
+    def read_file_entry(self, path, key, now):
+        db = PartDataCache.open_file(self, path)
+        try:
+            with db:
+                row = db.execute('SELECT expires, data FROM partdata WHERE key = ? AND expires > ?', (key, now)).fetchone()
+                if row is not None:
+                    db.execute('UPDATE partdata SET accessed = ? WHERE key = ?', (now, key))
+        finally:
+            db.close()
+        return row
+
+    # Expired and least recently used entries are removed on each write.
+    def write_file_entry(self, path, key, entry, size):
+        now = time.time()
+        db = PartDataCache.open_file(self, path)
+        try:
+            with db:
+                db.execute('INSERT OR REPLACE INTO partdata VALUES (?, ?, ?, ?)', (key, entry[0], now, entry[1]))
+                db.execute('DELETE FROM partdata WHERE expires <= ?', (now,))
+                db.execute('DELETE FROM partdata WHERE key IN (SELECT key FROM partdata ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (size,))
+        finally:
+            db.close()
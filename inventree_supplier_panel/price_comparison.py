@@ -0,0 +1,156 @@
+from djmoney.contrib.exchange.models import convert_money
+from djmoney.money import Money
+
+from company.models import SupplierPart
+from order.models import PurchaseOrder
+from part.models import Part
+from inventree_supplier_panel.parallel_lookup import ParallelLookup
+from inventree_supplier_panel.settings_cache import SettingsCache
+
+from bisect import bisect_right
+from decimal import Decimal, ROUND_CEILING
+
+# ----------------------------------------------------------------------------
+# Price comparison for all lines of a PO or the BOM of an assembly. For each
+# part all supplier parts of the registered suppliers are looked up in one
+# parallel run. For each offer the order quantity is calculated from the
+# required quantity, the minimum order quantity, the order multiple and the
+# first price break. The price breaks are sorted once per offer and the unit
+# price is found with a binary search. All prices are converted into the
+# InvenTree default currency.
+# For each line the cheapest offer and the fastest offer are selected. Fastest
+# is the cheapest offer that has the full quantity in stock. When no supplier
+# has enough stock, it is the offer with the most parts in stock.
+
+
+class PriceComparison():
+
+    # ------------------------------- compare --------------------------------
+    # rdata contains either 'order' with the pk of a PO or 'bom' with the pk of
+    # an assembly and the number of assemblies in 'quantity'.
+    def compare(self, rdata, suppliers, use_cache=True):
+        lines = PriceComparison.get_lines(self, rdata)
+        supplier_parts = {}
+        for sp in SupplierPart.objects.filter(part__in=[line['part'] for line in lines],
+                                              supplier__in=suppliers
+                                              ).select_related('supplier'):
+            supplier_parts.setdefault(sp.part_id, []).append(sp)
+        candidates = []
+        for line in lines:
+            for sp in supplier_parts.get(line['part'], []):
+                candidates.append((line, sp))
+        all_data = ParallelLookup.get_partdata_many(self, [(sp.supplier_id, sp.SKU, 'exact') for line, sp in candidates], use_cache=use_cache)
+
+        currency = SettingsCache.get_global_setting(self, 'INVENTREE_DEFAULT_CURRENCY')
+        for (line, sp), data in zip(candidates, all_data):
+            offer = PriceComparison.get_offer(self, line['quantity'], data, currency)
+            offer['supplier'] = sp.supplier.name
+            offer['supplier_part'] = sp.pk
+            offer['SKU'] = sp.SKU
+            line['offers'].append(offer)
+
+        totals = {'cheapest': Decimal(0),
+                  'fastest': Decimal(0),
+                  'currency': currency,
+                  'lines_without_offer': 0,
+                  }
+        for line in lines:
+            PriceComparison.select_offers(self, line)
+            if line['cheapest'] is None:
+                totals['lines_without_offer'] = totals['lines_without_offer'] + 1
+                continue
+            totals['cheapest'] = totals['cheapest'] + line['cheapest']['total']
+            totals['fastest'] = totals['fastest'] + line['fastest']['total']
+        return {'lines': lines, 'totals': totals}
+
+    # ------------------------------- get_lines ------------------------------
+    # The quantity of a PO line is in supplier packs. It is converted into parts.
+    def get_lines(self, rdata):
+        lines = []
+        if 'order' in rdata:
+            order = PurchaseOrder.objects.get(pk=int(rdata['order']))
+            for item in order.lines.filter(part__isnull=False).select_related('part__part'):
+                try:
+                    pack = int(item.part.pack_quantity)
+                except Exception:
+                    pack = 1
+                lines.append(PriceComparison.new_line(self, item.part.part, Decimal(item.quantity) * max(1, pack)))
+        else:
+            assembly = Part.objects.get(pk=int(rdata['bom']))
+            assemblies = Decimal(str(rdata.get('quantity', 1)))
+            for item in assembly.get_bom_items().select_related('sub_part'):
+                if item.sub_part.purchaseable:
+                    lines.append(PriceComparison.new_line(self, item.sub_part, Decimal(item.quantity) * assemblies))
+        return lines
+
+    def new_line(self, part, quantity):
+        return {'part': part.pk,
+                'IPN': part.IPN,
+                'name': part.name,
+                'quantity': quantity.to_integral_value(rounding=ROUND_CEILING),
+                'offers': [],
+                'cheapest': None,
+                'fastest': None,
+                }
+
+    # ------------------------------- get_offer ------------------------------
+    # Evaluates the part data of one supplier part for the required quantity.
+    # Offers without a price have total None and are not selected.
+    def get_offer(self, quantity, data, currency):
+        offer = {'order_quantity': 0,
+                 'stock': 0,
+                 'in_stock': False,
+                 'unit_price': None,
+                 'total': None,
+                 'currency': currency,
+                 'error': '',
+                 }
+        if data['error_status'] != 'OK':
+            offer['error'] = data['error_status']
+            return offer
+        if data['number_of_results'] == 0 or data['price_breaks'] == []:
+            offer['error'] = 'No price available'
+            return offer
+        quantities, prices, break_currency = PriceComparison.get_price_table(self, data['price_breaks'])
+        order_quantity = PriceComparison.get_order_quantity(self, quantity, data.get('moq', 1), data.get('mult', 1), quantities[0])
+        unit_price = prices[bisect_right(quantities, order_quantity) - 1]
+        offer['order_quantity'] = order_quantity
+        offer['stock'] = data.get('stock', 0)
+        offer['in_stock'] = offer['stock'] >= order_quantity
+        try:
+            offer['unit_price'] = PriceComparison.convert(self, unit_price, break_currency, currency)
+        except Exception:
+            offer['error'] = 'No exchange rate for ' + break_currency
+            return offer
+        offer['total'] = offer['unit_price'] * order_quantity
+        return offer
+
+    # The price breaks as sorted lists of quantities and unit prices.
+    def get_price_table(self, price_breaks):
+        table = sorted((Decimal(str(pb['Quantity'])), Decimal(str(pb['Price']))) for pb in price_breaks)
+        return [row[0] for row in table], [row[1] for row in table], price_breaks[0]['Currency']
+
+    def get_order_quantity(self, quantity, moq, mult, first_break):
+        try:
+            mult = max(1, int(mult))
+        except Exception:
+            mult = 1
+        quantity = max(Decimal(quantity), Decimal(moq), first_break)
+        return (quantity / mult).to_integral_value(rounding=ROUND_CEILING) * mult
+
+    def convert(self, amount, from_currency, currency):
+        if from_currency == currency:
+            return amount
+        return convert_money(Money(amount, from_currency), currency).amount
+
+    # ------------------------------- select_offers --------------------------
+    def select_offers(self, line):
+        offers = [offer for offer in line['offers'] if offer['total'] is not None]
+        if offers == []:
+            return
+        line['cheapest'] = min(offers, key=lambda offer: offer['total'])
+        in_stock = [offer for offer in offers if offer['in_stock']]
+        if in_stock == []:
+            line['fastest'] = max(offers, key=lambda offer: (offer['stock'], -offer['total']))
+        else:
+            line['fastest'] = min(in_stock, key=lambda offer: offer['total'])
@@ -0,0 +1,55 @@
+from decimal import Decimal
+import re
+
+# ----------------------------------------------------------------------------
+# Parser for prices that come as text like '1.456,34 €' or '$1,456.34'. The
+# pattern is compiled once at import and splits the number in one pass into
+# the integer part, the thousands separator with the groups of three digits
+# behind it and the decimals. So the decimal separator is found from the text
+# itself. Only a single separator with three digits behind it like in '1,456'
+# is ambiguous. Then the convention of the currency decides, except for a
+# leading 0 that never has a thousands group behind it. So '0.104 €' is
+# 0.104 also with EUR and '0,104' is 0.104 also with USD. Unknown
+# currencies use the decimal comma because this is what Mouser sends for the
+# European shops.
+# The result is a Decimal. Text without a number is 0.
+
+PRICE = re.compile(r"(\d+)(?:([.,' \u00a0\u202f])(\d{3}(?:\2\d{3})*)(?!\d))?(?:[.,](\d+))?")
+ZERO = Decimal(0)
+
+DECIMAL_POINT_CURRENCIES = {'AUD', 'CAD', 'CHF', 'CNY', 'GBP', 'HKD', 'ILS', 'INR', 'JPY',
+                            'KRW', 'MXN', 'MYR', 'NZD', 'PHP', 'SGD', 'THB', 'TWD', 'USD',
+                            }
+
+
+class PriceParser():
+
+    # ------------------------------- parse_price ----------------------------
+    def parse_price(self, price, currency=None):
+        match = PRICE.search(price)
+        if match is None:
+            return ZERO
+        integer, separator, groups, decimals = match.groups()
+        if separator is None:
+            number = integer
+        elif decimals is None and len(groups) == 3 and separator in '.,' and \
+                (integer[0] == '0' or separator == ('.' if currency in DECIMAL_POINT_CURRENCIES else ',')):
+            return Decimal(integer + '.' + groups)
+        else:
+            number = integer + groups.replace(separator, '')
+        if decimals is None:
+            return Decimal(number)
+        return Decimal(number + '.' + decimals)
+
+    # ------------------------------- parse_price_breaks ---------------------
+    # Parses all price breaks of a part in one pass. The breaks are in the
+    # supplier format with Quantity, Price and Currency. convert is applied to
+    # each price, e.g. float for the part data that is stored as json.
+    def parse_price_breaks(self, price_breaks, convert=None):
+        parsed = []
+        for pb in price_breaks:
+            price = PriceParser.parse_price(self, pb['Price'], pb['Currency'])
+            if convert is not None:
+                price = convert(price)
+            parsed.append({'Quantity': pb['Quantity'], 'Price': price, 'Currency': pb['Currency']})
+        return parsed
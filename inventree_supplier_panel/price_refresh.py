@@ -0,0 +1,155 @@
+from django.db import transaction
+from djmoney.money import Money
+
+from company.models import SupplierPart, SupplierPriceBreak
+from inventree_supplier_panel.parallel_lookup import ParallelLookup
+from inventree_supplier_panel.supplier_registry import SupplierRegistry
+
+from datetime import datetime
+from decimal import Decimal
+import json
+import time
+
+# ----------------------------------------------------------------------------
+# Background job that refreshes the price breaks of all supplier parts of the
+# registered suppliers. The parts are processed in chunks ordered by pk. Each
+# chunk is looked up in parallel and written in one transaction. Only changed
+# price breaks are written. After each chunk the pk of the last part is stored
+# in the setting PRICE_REFRESH_CURSOR. When a supplier reports that the request
+# quota is used up, the job stops and the next run continues from the cursor.
+# The progress is stored as json in the setting PRICE_REFRESH_STATUS. An error
+# sets the state to error, so the next run does not wait for STALE_TIME.
+# The lookups use the price_options of the supplier, so suppliers like Farnell
+# send only the small answer.
+
+DEFAULT_CHUNK_SIZE = 50
+PRICE_DIGITS = Decimal('0.000001')
+
+# A running job that did not report progress for this time is considered dead
+STALE_TIME = 3600
+
+
+class PriceRefresh():
+
+    def is_rate_limited(self, error_status):
+        return 'TooManyRequests' in str(error_status) or 'Too Many Requests' in str(error_status)
+
+    def get_status(self):
+        try:
+            return json.loads(self.get_setting('PRICE_REFRESH_STATUS'))
+        except Exception:
+            return {'state': 'never run'}
+
+    def set_status(self, status):
+        status['date'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        status['timestamp'] = time.time()
+        self.set_setting('PRICE_REFRESH_STATUS', json.dumps(status))
+
+    # ------------------------------- refresh_price_breaks -------------------
+    def refresh_price_breaks(self, suppliers):
+        status = PriceRefresh.get_status(self)
+        if status['state'] == 'running' and time.time() - status.get('timestamp', 0) < STALE_TIME:
+            return status
+        try:
+            chunk_size = int(self.get_setting('PRICE_REFRESH_CHUNK'))
+        except Exception:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        try:
+            pause = float(self.get_setting('PRICE_REFRESH_PAUSE'))
+        except Exception:
+            pause = 0
+        try:
+            cursor = int(self.get_setting('PRICE_REFRESH_CURSOR'))
+        except Exception:
+            cursor = 0
+
+        supplier_parts = SupplierPart.objects.filter(supplier__in=suppliers).order_by('pk')
+        options = {supplier: SupplierRegistry.get_price_options(self, supplier) for supplier in suppliers}
+        status = {'state': 'running',
+                  'total': supplier_parts.count(),
+                  'done': supplier_parts.filter(pk__lte=cursor).count(),
+                  'updated': 0,
+                  'errors': 0,
+                  }
+        PriceRefresh.set_status(self, status)
+
+        # An error stops the job. The cursor of the last finished chunk is kept
+        try:
+            while True:
+                chunk = list(supplier_parts.filter(pk__gt=cursor)[:chunk_size])
+                if chunk == []:
+                    break
+                all_data = ParallelLookup.get_partdata_many(self, [(sp.supplier_id, sp.SKU, options[sp.supplier_id]) for sp in chunk], use_cache=False)
+
+                # Everything in front of the first rate limited part is processed
+                found = []
+                rate_limited = False
+                for sp, data in zip(chunk, all_data):
+                    if PriceRefresh.is_rate_limited(self, data['error_status']):
+                        rate_limited = True
+                        break
+                    if data['error_status'] == 'OK' and data['number_of_results'] > 0:
+                        found.append((sp, data))
+                    else:
+                        status['errors'] = status['errors'] + 1
+                    cursor = sp.pk
+                    status['done'] = status['done'] + 1
+                status['updated'] = status['updated'] + PriceRefresh.update_price_breaks(self, found)
+                self.set_setting('PRICE_REFRESH_CURSOR', str(cursor))
+                if rate_limited:
+                    status['state'] = 'paused'
+                    PriceRefresh.set_status(self, status)
+                    return status
+                PriceRefresh.set_status(self, status)
+                time.sleep(pause)
+        except Exception as e:
+            status['state'] = 'error'
+            status['message'] = str(e)
+            PriceRefresh.set_status(self, status)
+            return status
+
+        self.set_setting('PRICE_REFRESH_CURSOR', '0')
+        status['state'] = 'finished'
+        PriceRefresh.set_status(self, status)
+        return status
+
+    # ------------------------------- update_price_breaks --------------------
+    # parts_data is a list of (supplier part, part data) tuples. Price breaks are
+    # matched by quantity. Returns the number of supplier parts with changes.
+    def update_price_breaks(self, parts_data):
+        existing = {}
+        for pb in SupplierPriceBreak.objects.filter(part__in=[sp for sp, data in parts_data]):
+            existing.setdefault(pb.part_id, {})[Decimal(pb.quantity)] = pb
+
+        to_create = []
+        to_update = []
+        to_delete = []
+        changed_parts = 0
+        for sp, data in parts_data:
+            old_breaks = existing.get(sp.pk, {})
+            changed = False
+            new_quantities = set()
+            for pb in data['price_breaks']:
+                quantity = Decimal(str(pb['Quantity']))
+                price = Money(Decimal(str(pb['Price'])).quantize(PRICE_DIGITS), pb['Currency'])
+                new_quantities.add(quantity)
+                old = old_breaks.get(quantity)
+                if old is None:
+                    to_create.append(SupplierPriceBreak(part=sp, quantity=quantity, price=price))
+                    changed = True
+                elif old.price != price:
+                    old.price = price
+                    to_update.append(old)
+                    changed = True
+            for quantity, old in old_breaks.items():
+                if quantity not in new_quantities:
+                    to_delete.append(old.pk)
+                    changed = True
+            if changed:
+                changed_parts = changed_parts + 1
+
+        with transaction.atomic():
+            SupplierPriceBreak.objects.filter(pk__in=to_delete).delete()
+            SupplierPriceBreak.objects.bulk_update(to_update, ['price', 'price_currency'])
+            SupplierPriceBreak.objects.bulk_create(to_create)
+        return changed_parts
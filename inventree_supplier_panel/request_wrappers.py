@@ -1,48 +1,298 @@
 import requests
 import os
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import NewConnectionError
+from inventree_supplier_panel.instrumentation import Instrumentation
+
+# ----------------------------------------------------------------------------
+# Pool of HTTP sessions. There is one session per supplier host and process.
+# Each session keeps its connections alive, so repeated requests to the same
+# supplier skip DNS, TCP, TLS and proxy CONNECT. The sessions are shared by all
+# supplier modules and threads.
+
+DEFAULT_POOL_SIZE = 10
+TIMEOUT = 15
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+# ----------------------------------------------------------------------------
+# Rate limit governor. Each supplier host has a token bucket with the allowed
+# requests per second and a burst capacity. A request waits until the bucket
+# has a token. The buckets also learn from the suppliers: Digikey reports the
+# remaining requests in the X-RateLimit-Remaining header, all suppliers may
+# answer 429 with Retry-After, and Mouser reports TooManyRequests in the body.
+# When the quota is used up, requests wait until the reset time. We never wait
+# longer than MAX_WAIT seconds. When the host is blocked for longer, the request
+# is not sent and TooManyRequests is raised. It is a ConnectionError, so all
+# callers handle it, and the price refresh pauses on it.
+
+RATE_LIMITS = {'api.mouser.com': {'rate': 0.5, 'capacity': 5},
+               'api.digikey.com': {'rate': 2, 'capacity': 10},
+               'api.element14.com': {'rate': 2, 'capacity': 2},
+               }
+MAX_WAIT = 30
+DEFAULT_RETRY_AFTER = 60
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+# ----------------------------------------------------------------------------
+# The supplier hosts can be redirected to another server, for example to the
+# mock server in mock_suppliers.py. This is only done by tests and benchmarks
+# with set_url_override, so the API keys never go to another host in normal
+# operation. Only scheme and host are replaced. The rate limits stay with the
+# original host.
+
+SUPPLIER_HOSTS = ['api.mouser.com', 'api.digikey.com', 'api.element14.com']
+
+url_overrides = {}
+
+
+# The request did not reach the supplier, so it is safe to repeat it. Other
+# ConnectionErrors may come after the supplier got the request.
+class RequestNotSent(ConnectionError):
+    pass
+
+
+# The request was not sent because the host is blocked for longer than MAX_WAIT
+class TooManyRequests(RequestNotSent):
+    pass
 
 
 # ----------------------------------------------------------------------------
 # Wrappers around the requests for better error handling
 class Wrappers():
 
-    def post_request(self, post_data, path, headers):
+    # ------------------------------- get_proxies ----------------------------
+    # The values in the environment variables overwrite the InvenTree settings.
+    def get_proxies(self):
         proxy_con = os.getenv('PROXY_CON')
         proxy_url = os.getenv('PROXY_URL')
         if proxy_con and proxy_url:
-            proxies = {proxy_con: proxy_url}
-        elif self.get_setting('PROXY_CON') != '' and self.get_setting('PROXY_URL') != '':
-            proxies = {self.get_setting('PROXY_CON'): self.get_setting('PROXY_URL')}
+            return {proxy_con: proxy_url}
+        proxy_con = self.get_setting('PROXY_CON')
+        proxy_url = self.get_setting('PROXY_URL')
+        if proxy_con and proxy_url:
+            return {proxy_con: proxy_url}
+        return {}
+
+    # ------------------------------- get_url --------------------------------
+    def get_url(self, path):
+        parts = urlsplit(path)
+        base_url = url_overrides.get(parts.netloc)
+        if not base_url:
+            return path
+        base = urlsplit(base_url)
+        return urlunsplit((base.scheme, base.netloc, parts.path, parts.query, parts.fragment))
+
+    # base_url None removes the override.
+    def set_url_override(self, host, base_url):
+        if base_url is None:
+            url_overrides.pop(host, None)
         else:
-            proxies = {}
+            url_overrides[host] = base_url
+
+    # ------------------------------- get_session ----------------------------
+    # Returns the pooled session for the host of path. The session is rebuilt
+    # when the pool size in the settings changes. The old session is not closed
+    # because other threads may still have requests running on it. It closes
+    # its connections when the last of them is done and it is garbage collected.
+    # Connection errors are retried for all requests. Server errors only for GET
+    # because a POST might have changed a cart already.
+    def get_session(self, path):
+        try:
+            pool_size = int(self.get_setting('HTTP_POOL_SIZE'))
+        except Exception:
+            pool_size = DEFAULT_POOL_SIZE
+        host = urlsplit(path).netloc
+        with sessions_lock:
+            session = sessions.get(host)
+            if session is not None and session.pool_size == pool_size:
+                return session
+            retry = Retry(total=3,
+                          connect=3,
+                          read=0,
+                          status=2,
+                          backoff_factor=0.3,
+                          status_forcelist=(502, 503, 504),
+                          allowed_methods=frozenset(['GET']),
+                          raise_on_status=False,
+                          )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            new_session = requests.Session()
+            new_session.mount('https://', adapter)
+            new_session.mount('http://', adapter)
+            new_session.pool_size = pool_size
+            sessions[host] = new_session
+        return new_session
+
+    # ------------------------------- close_sessions -------------------------
+    def close_sessions(self):
+        with sessions_lock:
+            for session in sessions.values():
+                session.close()
+            sessions.clear()
+
+    # ------------------------------- rate limits ----------------------------
+    def get_bucket(self, host):
+        bucket = buckets.get(host)
+        if bucket is None:
+            limits = RATE_LIMITS.get(host, {'rate': 0, 'capacity': 0})
+            bucket = {'rate': limits['rate'],
+                      'capacity': limits['capacity'],
+                      'tokens': limits['capacity'],
+                      'updated': time.monotonic(),
+                      'reset_at': 0,
+                      'remaining': None,
+                      'limit': None,
+                      'requests': 0,
+                      'throttled': 0,
+                      'waited': 0.0,
+                      'rejected': 0,
+                      }
+            buckets[host] = bucket
+        return bucket
+
+    # Waits until the bucket of the host allows the next request. Raises
+    # TooManyRequests when that would take longer than MAX_WAIT in total.
+    def acquire_rate_limit(self, host):
+        waited = 0.0
+        while True:
+            with buckets_lock:
+                bucket = Wrappers.get_bucket(self, host)
+                now = time.monotonic()
+                if bucket['rate'] > 0:
+                    bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+                bucket['updated'] = now
+                if bucket['reset_at'] > now:
+                    wait = bucket['reset_at'] - now
+                elif bucket['rate'] == 0 or bucket['tokens'] >= 1:
+                    wait = 0
+                else:
+                    wait = (1 - bucket['tokens']) / bucket['rate']
+                if wait == 0:
+                    bucket['tokens'] = bucket['tokens'] - 1
+                    bucket['requests'] = bucket['requests'] + 1
+                    if waited > 0:
+                        bucket['throttled'] = bucket['throttled'] + 1
+                        bucket['waited'] = bucket['waited'] + waited
+                        Instrumentation.record(self, 'rate_limit_wait', waited, {'host': host})
+                    return
+                if waited + wait > MAX_WAIT:
+                    bucket['rejected'] = bucket['rejected'] + 1
+                    Instrumentation.count(self, 'rate_limited', {'host': host})
+                    raise TooManyRequests('TooManyRequests')
+            time.sleep(wait)
+            waited = waited + wait
+
+    # Learns the remaining budget from the answer of the supplier.
+    def update_rate_limit(self, host, headers, status_code):
+        with buckets_lock:
+            bucket = Wrappers.get_bucket(self, host)
+            remaining = None
+            try:
+                remaining = int(headers['X-RateLimit-Remaining'])
+                bucket['remaining'] = remaining
+                bucket['limit'] = int(headers['X-RateLimit-Limit'])
+            except Exception:
+                pass
+            if status_code == 429 or remaining == 0:
+                try:
+                    retry_after = int(headers['Retry-After'])
+                except Exception:
+                    retry_after = DEFAULT_RETRY_AFTER
+                bucket['reset_at'] = time.monotonic() + retry_after
+
+    # For suppliers that report the exhausted quota in the body like Mouser.
+    def report_rate_limit(self, path, retry_after=DEFAULT_RETRY_AFTER):
+        with buckets_lock:
+            bucket = Wrappers.get_bucket(self, urlsplit(path).netloc)
+            bucket['remaining'] = 0
+            bucket['reset_at'] = time.monotonic() + retry_after
+
+    def get_rate_limit_stats(self):
+        stats = {}
+        with buckets_lock:
+            now = time.monotonic()
+            for host, bucket in buckets.items():
+                stats[host] = {'remaining': bucket['remaining'],
+                               'limit': bucket['limit'],
+                               'blocked_for': max(0, int(bucket['reset_at'] - now)),
+                               'requests': bucket['requests'],
+                               'throttled': bucket['throttled'],
+                               'waited': round(bucket['waited'], 1),
+                               'rejected': bucket['rejected'],
+                               }
+        return stats
+
+    # ------------------------------- measurements ---------------------------
+    def measure_response(self, host, response, seconds):
+        response.supplier_host = host
+        Instrumentation.record(self, 'http', seconds, {'host': host})
+        Instrumentation.count(self, 'requests', {'host': host, 'status': response.status_code})
+        Instrumentation.count(self, 'bytes_received', {'host': host}, len(response.content))
         try:
-            response = requests.post(path,
-                                     proxies=proxies,
-                                     data=post_data,
-                                     timeout=15,
-                                     headers=headers
-                                     )
+            Instrumentation.count(self, 'bytes_sent', {'host': host}, len(response.request.body or ''))
+        except Exception:
+            pass
+
+    # True when the connection could not be opened. Then nothing was sent.
+    def is_connect_error(self, e):
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0] if e.args else None, 'reason', None)
+        return isinstance(e, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+    # response.json() with the time for the parsing
+    def get_json(self, response):
+        host = getattr(response, 'supplier_host', urlsplit(response.url).netloc)
+        with Instrumentation.timer(self, 'json', {'host': host}):
+            return response.json()
+
+    def post_request(self, post_data, path, headers):
+        host = urlsplit(path).netloc
+        path = Wrappers.get_url(self, path)
+        Wrappers.acquire_rate_limit(self, host)
+        start = time.perf_counter()
+        try:
+            response = Wrappers.get_session(self, path).post(path,
+                                                             proxies=Wrappers.get_proxies(self),
+                                                             data=post_data,
+                                                             timeout=TIMEOUT,
+                                                             headers=headers
+                                                             )
         except Exception as e:
             self.status_code = e.args
+            Instrumentation.count(self, 'connection_errors', {'host': host})
+            if Wrappers.is_connect_error(self, e):
+                raise RequestNotSent
             raise ConnectionError
+        Wrappers.measure_response(self, host, response, time.perf_counter() - start)
+        Wrappers.update_rate_limit(self, host, response.headers, response.status_code)
         return (response)
 
     def get_request(self, path, headers):
-        proxy_con = os.getenv('PROXY_CON')
-        proxy_url = os.getenv('PROXY_URL')
-        if proxy_con and proxy_url:
-            proxies = {proxy_con: proxy_url}
-        elif self.get_setting('PROXY_CON') != '' and self.get_setting('PROXY_URL') != '':
-            proxies = {self.get_setting('PROXY_CON'): self.get_setting('PROXY_URL')}
-        else:
-            proxies = {}
+        host = urlsplit(path).netloc
+        path = Wrappers.get_url(self, path)
+        Wrappers.acquire_rate_limit(self, host)
+        start = time.perf_counter()
         try:
-            response = requests.get(path,
-                                    proxies=proxies,
-                                    timeout=15,
-                                    headers=headers
-                                    )
+            response = Wrappers.get_session(self, path).get(path,
+                                                            proxies=Wrappers.get_proxies(self),
+                                                            timeout=TIMEOUT,
+                                                            headers=headers
+                                                            )
         except Exception as e:
             self.status_code = e.args
+            Instrumentation.count(self, 'connection_errors', {'host': host})
+            if Wrappers.is_connect_error(self, e):
+                raise RequestNotSent
             raise ConnectionError
+        Wrappers.measure_response(self, host, response, time.perf_counter() - start)
+        Wrappers.update_rate_limit(self, host, response.headers, response.status_code)
         return (response)
@@ -0,0 +1,112 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from common.models import InvenTreeSetting
+from plugin.models import PluginSetting
+
+import hashlib
+import threading
+import time
+
+# ----------------------------------------------------------------------------
+# Per process snapshot of the plugin settings and the InvenTree settings that
+# the plugin uses. Each setting is read from the database once and then served
+# from the snapshot. When a setting is saved or deleted, the snapshot of this
+# process is dropped. The other server processes and the background worker
+# read a fingerprint of the stored settings every SNAPSHOT_TTL seconds with one
+# query and drop their snapshots when it changed. So a change reaches all
+# processes after SNAPSHOT_TTL seconds at the latest, without a shared cache.
+# The Digikey tokens and the state of the price refresh are written by other
+# processes all the time. They are always read from the database and are not
+# part of the fingerprint.
+
+SNAPSHOT_TTL = 10
+PLUGIN_KEY = 'suppliercart'
+GLOBAL_KEYS = ['INVENTREE_BASE_URL',
+               'INVENTREE_DEFAULT_CURRENCY',
+               ]
+NO_CACHE_KEYS = ['DIGIKEY_TOKEN',
+                 'DIGIKEY_REFRESH_TOKEN',
+                 'DIGIKEY_TOKEN_EXPIRES',
+                 'PRICE_REFRESH_STATUS',
+                 'PRICE_REFRESH_CURSOR',
+                 ]
+
+snapshot = {'values': {},
+            'version': None,
+            'checked': 0,
+            'generation': 0,
+            }
+snapshot_lock = threading.Lock()
+
+
+class SettingsCache():
+
+    # ------------------------------- get_setting ----------------------------
+    # load reads the setting from the database if it is not in the snapshot.
+    def get_setting(self, key, load):
+        if key in NO_CACHE_KEYS:
+            return load()
+        SettingsCache.check_version(self)
+        with snapshot_lock:
+            if key in snapshot['values']:
+                return snapshot['values'][key]
+            generation = snapshot['generation']
+        value = load()
+        with snapshot_lock:
+            if generation == snapshot['generation']:
+                snapshot['values'][key] = value
+        return value
+
+    def get_global_setting(self, key):
+        return SettingsCache.get_setting(self, 'global:' + key, lambda: InvenTreeSetting.get_setting(key))
+
+    # The generation changes each time the snapshot is dropped. Objects that are
+    # built from settings can use it to see that they are outdated.
+    def get_generation(self):
+        SettingsCache.check_version(self)
+        with snapshot_lock:
+            return snapshot['generation']
+
+    # ------------------------------- check_version --------------------------
+    # Compares the fingerprint of the stored settings every SNAPSHOT_TTL seconds.
+    # The query runs without the lock. If it fails, the snapshot is kept.
+    def check_version(self):
+        with snapshot_lock:
+            now = time.monotonic()
+            if now - snapshot['checked'] < SNAPSHOT_TTL:
+                return
+            snapshot['checked'] = now
+        try:
+            version = SettingsCache.read_version(self)
+        except Exception:
+            return
+        with snapshot_lock:
+            if version != snapshot['version']:
+                snapshot['values'] = {}
+                snapshot['version'] = version
+                snapshot['generation'] = snapshot['generation'] + 1
+
+    # The InvenTree settings in GLOBAL_KEYS are part of the fingerprint too.
+    def read_version(self):
+        rows = list(PluginSetting.objects.filter(plugin__key=PLUGIN_KEY).exclude(key__in=NO_CACHE_KEYS).order_by('key').values_list('key', 'value'))
+        rows = rows + list(InvenTreeSetting.objects.filter(key__in=GLOBAL_KEYS).order_by('key').values_list('key', 'value'))
+        return hashlib.sha1(repr(rows).encode()).hexdigest()
+
+    # ------------------------------- invalidate -----------------------------
+    # Drops the snapshot of this process. The other processes see the change
+    # in the fingerprint.
+    def invalidate(self):
+        with snapshot_lock:
+            snapshot['values'] = {}
+            snapshot['checked'] = time.monotonic()
+            snapshot['generation'] = snapshot['generation'] + 1
+
+
+@receiver(post_save, sender=PluginSetting, dispatch_uid='supplier_panel_plugin_setting_saved')
+@receiver(post_delete, sender=PluginSetting, dispatch_uid='supplier_panel_plugin_setting_deleted')
+@receiver(post_save, sender=InvenTreeSetting, dispatch_uid='supplier_panel_global_setting_saved')
+@receiver(post_delete, sender=InvenTreeSetting, dispatch_uid='supplier_panel_global_setting_deleted')
+def setting_changed(sender, instance, **kwargs):
+    if instance.key not in NO_CACHE_KEYS:
+        SettingsCache.invalidate(None)
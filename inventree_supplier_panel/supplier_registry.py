@@ -0,0 +1,123 @@
+from inventree_supplier_panel.settings_cache import SettingsCache
+from inventree_supplier_panel.mouser import Mouser
+from inventree_supplier_panel.digikey import Digikey
+from inventree_supplier_panel.farnell import Farnell
+
+from types import MappingProxyType
+import threading
+
+# ----------------------------------------------------------------------------
+# Registry of the suppliers. SUPPLIERS contains the definition of each supported
+# supplier with the setting that holds the pk of the supplier company and the
+# supplier dependant functions. get_partdata_many is None for suppliers without
+# batch searches. They are never searched in batches. cart_in_packs is True when
+# the cart quantity is the PO quantity times the pack quantity. price_options are
+# the search options of lookups that need only the prices. cache_settings are
+# the settings that change the answer of the supplier. They are part of the part
+# data cache key.
+# Further suppliers can be added with register_supplier.
+# From the definitions and the settings we build an immutable registry that is
+# indexed by the supplier pk. It is built once per settings snapshot and shared
+# by all requests. Nothing in it is changed afterwards, so parallel requests
+# cannot disturb each other.
+
+SUPPLIERS = [{'name': 'Mouser',
+              'pk_setting': 'MOUSER_PK',
+              'po_template': 'supplier_panel/mouser.html',
+              'get_partdata': Mouser.get_mouser_partdata,
+              'get_partdata_many': Mouser.get_mouser_partdata_many,
+              'batch_size': Mouser.BATCH_SIZE,
+              'update_cart': Mouser.update_mouser_cart,
+              'create_cart': Mouser.create_mouser_cart,
+              'cart_in_packs': False,
+              'price_options': 'exact',
+              'cache_settings': ('MOUSERLANGUAGE',),
+              },
+             {'name': 'Digikey',
+              'pk_setting': 'DIGIKEY_PK',
+              'po_template': 'supplier_panel/mouser.html',
+              'get_partdata': Digikey.get_digikey_partdata_v4,
+              'get_partdata_many': None,
+              'batch_size': 1,
+              'update_cart': Digikey.update_digikey_cart,
+              'create_cart': Digikey.create_digikey_cart,
+              'cart_in_packs': True,
+              'price_options': 'exact',
+              'cache_settings': (),
+              },
+             {'name': 'Farnell',
+              'pk_setting': 'FARNELL_PK',
+              'po_template': 'supplier_panel/mouser.html',
+              'get_partdata': Farnell.get_farnell_partdata,
+              'get_partdata_many': Farnell.get_farnell_partdata_many,
+              'batch_size': Farnell.BATCH_SIZE,
+              'update_cart': Farnell.update_farnell_cart,
+              'create_cart': Farnell.create_farnell_cart,
+              'cart_in_packs': False,
+              'price_options': 'prices',
+              'cache_settings': ('FARNELL_STORE', 'FARNELL_CURRENCY', 'FARNELL_RESPONSE_GROUP'),
+              },
+             ]
+
+current = {'generation': None,
+           'registry': None,
+           }
+current_lock = threading.Lock()
+
+
+class SupplierRegistry():
+
+    # ------------------------------- get_registry ---------------------------
+    # Returns the registry for the actual settings. It has two read only parts:
+    # 'by_pk' maps the pk to the supplier entry of each registered supplier.
+    # 'suppliers' is a tuple of all supplier entries including the ones without
+    # pk. The entries contain the definition plus 'pk' and 'is_registered'.
+    def get_registry(self):
+        generation = SettingsCache.get_generation(self)
+        with current_lock:
+            if current['generation'] == generation and current['registry'] is not None:
+                return current['registry']
+        registry = SupplierRegistry.build_registry(self)
+        with current_lock:
+            current['generation'] = generation
+            current['registry'] = registry
+        return registry
+
+    def build_registry(self):
+        by_pk = {}
+        suppliers = []
+        for definition in SUPPLIERS:
+            entry = dict(definition)
+            try:
+                entry['pk'] = int(self.get_setting(definition['pk_setting']))
+                entry['is_registered'] = True
+            except Exception:
+                entry['pk'] = 0
+                entry['is_registered'] = False
+            entry = MappingProxyType(entry)
+            suppliers.append(entry)
+            if entry['is_registered']:
+                by_pk[entry['pk']] = entry
+        return MappingProxyType({'by_pk': MappingProxyType(by_pk),
+                                 'suppliers': tuple(suppliers),
+                                 })
+
+    # ------------------------------- get_supplier ---------------------------
+    # Returns the entry of the supplier with the pk or None.
+    def get_supplier(self, pk):
+        return SupplierRegistry.get_registry(self)['by_pk'].get(pk)
+
+    # The search options of a price lookup for the supplier with the pk
+    def get_price_options(self, pk):
+        entry = SupplierRegistry.get_supplier(self, pk)
+        if entry is None:
+            return 'exact'
+        return entry.get('price_options', 'exact')
+
+    # ------------------------------- register_supplier ----------------------
+    # Adds a supplier definition with the same keys as in SUPPLIERS. The plugin
+    # needs a setting with the name in pk_setting.
+    def register_supplier(self, definition):
+        with current_lock:
+            SUPPLIERS.append(definition)
+            current['registry'] = None
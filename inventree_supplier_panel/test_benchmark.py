@@ -0,0 +1,172 @@
+"""Benchmarks against the local mock supplier server
+
+The benchmarks are skipped unless SUPPLIER_PANEL_BENCHMARK is set. Optional:
+SUPPLIER_PANEL_BENCHMARK_SIZES      PO sizes, default 10,100,1000,5000
+SUPPLIER_PANEL_BENCHMARK_LATENCY    latency of the mock server in seconds, default 0.05
+SUPPLIER_PANEL_BENCHMARK_OUTPUT     file for the results as json
+"""
+
+from django.test import RequestFactory, TransactionTestCase
+import json
+import os
+import re
+import time
+import unittest
+
+from common.models import InvenTreeSetting
+from company.models import Company, ManufacturerPart, SupplierPart
+from order.models import PurchaseOrder, PurchaseOrderLineItem
+from part.models import Part
+
+from .supplier_panel import SupplierCartPanel
+from .parallel_lookup import ParallelLookup
+from .request_wrappers import Wrappers
+from . import request_wrappers
+from .mock_suppliers import MockSuppliers
+from .price_parser import PriceParser
+
+BENCHMARK = os.getenv('SUPPLIER_PANEL_BENCHMARK')
+SIZES = [int(size) for size in os.getenv('SUPPLIER_PANEL_BENCHMARK_SIZES', '10,100,1000,5000').split(',')]
+LATENCY = float(os.getenv('SUPPLIER_PANEL_BENCHMARK_LATENCY', '0.05'))
+
+
+# The price parsing of Mouser before PriceParser. It is the reference for the
+# price parser benchmark.
+def legacy_reformat_price(price):
+    price = price.replace('.', '')
+    price = price.replace(',', '.')
+    non_decimal = re.compile(r'[^\d.]+')
+    price = non_decimal.sub('', price)
+    if price == '':
+        return 0
+    return float(price)
+
+
+# The lookups run in worker threads with their own database connections. So the
+# test data must be committed and we need a TransactionTestCase.
+@unittest.skipUnless(BENCHMARK, 'Set SUPPLIER_PANEL_BENCHMARK to run the benchmarks')
+class BenchmarkSupplierPanel(TransactionTestCase):
+
+    def setUp(self):
+        self.server = MockSuppliers(latency=LATENCY)
+        base_url = self.server.start()
+        for host in request_wrappers.SUPPLIER_HOSTS:
+            Wrappers.set_url_override(self, host, base_url)
+
+        # The governor would measure the supplier quotas and not the plugin
+        self.rate_limits = request_wrappers.RATE_LIMITS
+        request_wrappers.RATE_LIMITS = {}
+        request_wrappers.buckets.clear()
+
+        InvenTreeSetting.set_setting('INVENTREE_DEFAULT_CURRENCY', 'EUR', None)
+        self.plugin = SupplierCartPanel()
+        self.suppliers = {}
+        for name in ['Mouser', 'Digikey', 'Farnell']:
+            self.suppliers[name] = Company.objects.create(name=name, is_supplier=True, currency='EUR')
+            self.plugin.set_setting(name.upper() + '_PK', str(self.suppliers[name].pk))
+        self.manufacturer = Company.objects.create(name='Mock', is_manufacturer=True)
+        self.plugin.set_setting('MOUSERSEARCHKEY', 'benchmark')
+        self.plugin.set_setting('MOUSERCARTKEY', 'benchmark')
+        self.plugin.set_setting('FARNELLSEARCHKEY', 'benchmark')
+        self.plugin.set_setting('DIGIKEY_CLIENT_ID', 'benchmark')
+        self.plugin.set_setting('PARTDATA_CACHE_TTL', '0')
+        self.results = []
+
+    def tearDown(self):
+        self.server.stop()
+        for host in request_wrappers.SUPPLIER_HOSTS:
+            Wrappers.set_url_override(self, host, None)
+        request_wrappers.RATE_LIMITS = self.rate_limits
+        request_wrappers.buckets.clear()
+
+    # ------------------------------- test data ------------------------------
+    # Creates size parts with a manufacturer part each and a PO for every
+    # supplier except Farnell. Farnell is used for the supplier part creation.
+    def create_data(self, size):
+        parts = []
+        for i in range(size):
+            parts.append(Part.objects.create(name=f'Benchmark {size} {i}',
+                                             IPN=f'B-{size}-{i}',
+                                             description='Benchmark part',
+                                             purchaseable=True,
+                                             component=True))
+        manufacturer_parts = ManufacturerPart.objects.bulk_create([ManufacturerPart(part=part, manufacturer=self.manufacturer, MPN=part.IPN)
+                                                                   for part in parts])
+        orders = {}
+        for name in ['Mouser', 'Digikey']:
+            supplier_parts = SupplierPart.objects.bulk_create([SupplierPart(part=mp.part,
+                                                                            supplier=self.suppliers[name],
+                                                                            manufacturer_part=mp,
+                                                                            SKU=name[0] + '-' + mp.MPN,
+                                                                            pack_quantity='1')
+                                                               for mp in manufacturer_parts])
+            orders[name] = PurchaseOrder.objects.create(reference=PurchaseOrder.generate_reference(), supplier=self.suppliers[name])
+            PurchaseOrderLineItem.objects.bulk_create([PurchaseOrderLineItem(order=orders[name], part=sp, quantity=1 + i % 20)
+                                                       for i, sp in enumerate(supplier_parts)])
+        return manufacturer_parts, orders
+
+    def measure(self, size, operation, function):
+        requests = len(self.server.requests)
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        self.results.append({'size': size,
+                             'operation': operation,
+                             'seconds': round(seconds, 3),
+                             'per_line_ms': round(1000 * seconds / size, 2),
+                             'requests': len(self.server.requests) - requests,
+                             })
+        return result
+
+    # ------------------------------- benchmark ------------------------------
+    def test_benchmark(self):
+        factory = RequestFactory()
+        for size in SIZES:
+            manufacturer_parts, orders = self.create_data(size)
+
+            for name in ['Mouser', 'Digikey']:
+                lookups = [(sp.supplier_id, sp.SKU, 'exact') for sp in SupplierPart.objects.filter(supplier=self.suppliers[name], part__in=[mp.part for mp in manufacturer_parts])]
+                all_data = self.measure(size, 'get_partdata ' + name, lambda: ParallelLookup.get_partdata_many(self.plugin, lookups, use_cache=False))
+                self.assertEqual([data['error_status'] for data in all_data], ['OK'] * size)
+
+            lines = [{'pk': mp.part_id, 'mpart': mp.pk, 'supplier': self.suppliers['Farnell'].pk, 'sku': 'F-' + mp.MPN, 'ignoreMPNCheck': True}
+                     for mp in manufacturer_parts]
+            request = factory.post('/', data=json.dumps({'lines': lines}), content_type='application/json')
+            response = self.measure(size, 'add_supplierparts Farnell', lambda: self.plugin.add_supplierparts(request))
+            results = json.loads(response.content)['results']
+            self.assertEqual([result['message'] for result in results], ['OK'] * size)
+
+            for name in ['Mouser', 'Digikey']:
+                cart_data = self.measure(size, 'transfer_cart ' + name, lambda: self.plugin.run_transfer_cart(orders[name].pk))
+                self.assertEqual(cart_data['message'], 'OK')
+                self.assertEqual(len(cart_data['CartItems']), size)
+            cart_data = self.measure(size, 'transfer_cart Mouser again', lambda: self.plugin.run_transfer_cart(orders['Mouser'].pk))
+            self.assertEqual(cart_data['message'], 'OK')
+
+        print()
+        print(f"{'size':>6} {'operation':<28} {'seconds':>9} {'ms/line':>9} {'requests':>9}")
+        for result in self.results:
+            print(f"{result['size']:>6} {result['operation']:<28} {result['seconds']:>9} {result['per_line_ms']:>9} {result['requests']:>9}")
+        output = os.getenv('SUPPLIER_PANEL_BENCHMARK_OUTPUT')
+        if output:
+            with open(output, 'w') as f:
+                json.dump(self.results, f, indent=2)
+
+    # ------------------------------- price parser ---------------------------
+    # The price breaks of a large Mouser search result. Both parsers must give
+    # the same prices for the European format.
+    def test_price_parser(self):
+        price_breaks = []
+        for i in range(max(SIZES) * 10):
+            price_breaks.append({'Quantity': 10 ** (i % 5), 'Price': f'{1000 / (i + 1):.4f} €'.replace('.', ','), 'Currency': 'EUR'})
+
+        start = time.perf_counter()
+        legacy = [legacy_reformat_price(pb['Price']) for pb in price_breaks]
+        legacy_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        parsed = PriceParser.parse_price_breaks(self, price_breaks)
+        seconds = time.perf_counter() - start
+        self.assertEqual([float(pb['Price']) for pb in parsed], legacy)
+
+        print()
+        print(f'{len(price_breaks)} price breaks: legacy {legacy_seconds:.3f} s, PriceParser {seconds:.3f} s')
@@ -1,13 +1,45 @@
 """Basic unit tests for the plugin"""
 
 from httmock import urlmatch, HTTMock, response
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory, TestCase
+import json
+import os
+import tempfile
+import time
+from decimal import Decimal
+from types import SimpleNamespace
 
 from plugin import InvenTreePlugin
 from plugin.mixins import SettingsMixin
+from company.models import Company, ManufacturerPart, SupplierPart, SupplierPriceBreak
+from part.models import Part
+from order.models import PurchaseOrder, PurchaseOrderLineItem
 
 from .mouser import Mouser
+from .price_parser import PriceParser
 from .farnell import Farnell
+from .digikey import Digikey
+from . import digikey
+from .partdata_cache import PartDataCache
+from . import partdata_cache
+from .request_wrappers import Wrappers
+from . import request_wrappers
+from .settings_cache import SettingsCache
+from . import settings_cache
+from .supplier_registry import SupplierRegistry
+from .cart_export import CartExport
+from .cart_snapshot import CartSnapshots
+from .meta_access import MetaAccess
+from . import cart_export
+from .price_comparison import PriceComparison
+from .availability_check import AvailabilityCheck
+from .mock_suppliers import MockSuppliers
+from .instrumentation import Instrumentation
+from .supplier_panel import SupplierCartPanel
+from .price_refresh import PriceRefresh
+from . import price_refresh
+from .parallel_lookup import ParallelLookup
 
 
 class TestCartPlugin(TestCase, SettingsMixin, InvenTreePlugin):
@@ -20,6 +52,36 @@ class TestCartPlugin(TestCase, SettingsMixin, InvenTreePlugin):
         self.assertEqual(Mouser.reformat_mouser_price(self, '1,56 $'), 1.56)
         self.assertEqual(Mouser.reformat_mouser_price(self, ''), 0)
         self.assertEqual(Mouser.reformat_mouser_price(self, 'Mumpitz'), 0)
+        self.assertEqual(Mouser.reformat_mouser_price(self, '$1,456.34', 'USD'), 1456.34)
+
+    # -------------------------------------------------------------------------
+    def test_parse_price(self):
+
+        self.assertEqual(PriceParser.parse_price(self, '1.456,34 €', 'EUR'), Decimal('1456.34'))
+        self.assertEqual(PriceParser.parse_price(self, '$1,456.34', 'USD'), Decimal('1456.34'))
+        self.assertEqual(PriceParser.parse_price(self, '0.104 $', 'USD'), Decimal('0.104'))
+        self.assertEqual(PriceParser.parse_price(self, '1 234,50 €', 'EUR'), Decimal('1234.50'))
+        self.assertEqual(PriceParser.parse_price(self, "CHF 1'234.50", 'CHF'), Decimal('1234.50'))
+        self.assertEqual(PriceParser.parse_price(self, '1.234.567', 'USD'), Decimal('1234567'))
+
+        # Only here the currency decides
+        self.assertEqual(PriceParser.parse_price(self, '1,456', 'USD'), Decimal('1456'))
+        self.assertEqual(PriceParser.parse_price(self, '1,456', 'EUR'), Decimal('1.456'))
+        self.assertEqual(PriceParser.parse_price(self, '1.456', 'EUR'), Decimal('1456'))
+        self.assertEqual(PriceParser.parse_price(self, '12345,67 €', 'EUR'), Decimal('12345.67'))
+
+        # A leading 0 has no thousands group behind it
+        self.assertEqual(PriceParser.parse_price(self, '0.104 €', 'EUR'), Decimal('0.104'))
+        self.assertEqual(PriceParser.parse_price(self, '€0.104', 'EUR'), Decimal('0.104'))
+        self.assertEqual(PriceParser.parse_price(self, '0,104', 'USD'), Decimal('0.104'))
+        self.assertEqual(PriceParser.parse_price(self, '0,104 €'), Decimal('0.104'))
+
+        price_breaks = [{'Quantity': 1, 'Price': '0,50 €', 'Currency': 'EUR'},
+                        {'Quantity': 10, 'Price': '$0.104', 'Currency': 'USD'}]
+        self.assertEqual(PriceParser.parse_price_breaks(self, price_breaks),
+                         [{'Quantity': 1, 'Price': Decimal('0.50'), 'Currency': 'EUR'},
+                          {'Quantity': 10, 'Price': Decimal('0.104'), 'Currency': 'USD'}])
+        self.assertEqual(PriceParser.parse_price_breaks(self, price_breaks, float)[1]['Price'], 0.104)
 
     # -------------------------------------------------------------------------
     def test_get_mouser_package(self):
@@ -94,6 +156,14 @@ class TestCartPlugin(TestCase, SettingsMixin, InvenTreePlugin):
             data = Mouser.get_mouser_partdata(self, 'LTC7806IUFDM#WPBF', 'none')
         self.assertEqual(data['error_status'], 'WhatEverCode', 'Some unknown error')
 
+        # No JSON in the answer. The content is the error status
+        @urlmatch(netloc=r'(.*\.)?api\.mouser\.com.*')
+        def mouser_mock(url, request):
+            return response(503, b'Service Unavailable', {}, None, 5, request)
+        with HTTMock(mouser_mock):
+            data = Mouser.get_mouser_partdata(self, 'LTC7806IUFDM#WPBF', 'none')
+        self.assertEqual(data['error_status'], "b'Service Unavailable'")
+
     # -------------------------------------------------------------------------
     # Test with corect data, one result returned. Because we do not want to
     # distribute a valid key and need a stable response, we mock the Mouser
@@ -163,17 +233,166 @@ class TestCartPlugin(TestCase, SettingsMixin, InvenTreePlugin):
         self.assertEqual(data['package'], '')
         self.assertEqual(data['price_breaks'], [])
 
+    # -------------------------------------------------------------------------
+    # Many SKUs in one request. The parts in the answer are sorted back to the
+    # requested SKUs.
+
+    def test_get_mouser_partdata_many(self):
+
+        headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
+        parts = []
+        for sku in ['595-TPS7A2033PDBVR', '595-TPS7A2033PDBVR', '81-GRM155R71C104KA8D']:
+            parts.append({'Description': 'Description ' + sku,
+                          'LifecycleStatus': None,
+                          'ManufacturerPartNumber': sku[4:],
+                          'Mult': '1',
+                          'MouserPartNumber': sku,
+                          'ProductAttributes': [],
+                          'PriceBreaks': [{'Quantity': 1, 'Price': '0,50 €', 'Currency': 'EUR'}],
+                          'ProductDetailUrl': 'https://www.mouser.de/ProductDetail/' + sku})
+        content = {'Errors': [], 'SearchResults': {'NumberOfResult': 3, 'Parts': parts}}
+        requests = []
+
+        @urlmatch(netloc=r'(.*\.)?api\.mouser\.com.*')
+        def mouser_mock(url, request):
+            requests.append(request.body)
+            return response(200, content, headers, None, 5, request)
+
+        with HTTMock(mouser_mock):
+            data = Mouser.get_mouser_partdata_many(self, ['595-TPS7A2033PDBVR', '81-GRM155R71C104KA8D', 'blabla'], 'exact')
+        self.assertEqual(len(requests), 1)
+        self.assertIn('595-TPS7A2033PDBVR|81-GRM155R71C104KA8D|blabla', str(requests[0]))
+        self.assertEqual(data['595-TPS7A2033PDBVR']['number_of_results'], 2)
+        self.assertEqual(data['81-GRM155R71C104KA8D']['number_of_results'], 1)
+        self.assertEqual(data['81-GRM155R71C104KA8D']['MPN'], 'GRM155R71C104KA8D')
+        self.assertEqual(data['81-GRM155R71C104KA8D']['price_breaks'], [{'Quantity': 1, 'Price': 0.5, 'Currency': 'EUR'}])
+        self.assertEqual(data['blabla']['error_status'], 'OK')
+        self.assertEqual(data['blabla']['number_of_results'], 0)
+
+        # Errors are reported for all SKUs of the request
+        content = {'Errors': [{'Code': 'TooManyRequests'}], 'SearchResults': None}
+        with HTTMock(mouser_mock):
+            data = Mouser.get_mouser_partdata_many(self, ['595-TPS7A2033PDBVR', 'blabla'], 'exact')
+        self.assertEqual(data['595-TPS7A2033PDBVR']['error_status'], 'TooManyRequests')
+        self.assertEqual(data['blabla']['error_status'], 'TooManyRequests')
+
     def test_create_mouser_cart(self):
         data = Mouser.create_mouser_cart(self, 0)
         self.assertEqual(data['ID'], '')
         self.assertEqual(data['error_status'], 'OK')
+
+    # -------------------------------------------------------------------------
+    # Repeated transfers only send the changed lines
+
+    def test_diff_mouser_cart(self):
+
+        headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
+        content = {'Errors': [], 'CartKey': 'abc', 'CurrencyCode': 'EUR', 'MerchandiseTotal': 0, 'CartItems': []}
+        requests = []
+
+        @urlmatch(netloc=r'(.*\.)?api\.mouser\.com.*')
+        def mouser_mock(url, request):
+            requests.append((request.method, url.path, request.body))
+            return response(200, content, headers, None, 5, request)
+
+        def line(sku, quantity):
+            return {'MouserPartNumber': sku, 'Quantity': quantity, 'CustomerPartNumber': 'IPN-' + sku}
+
+        last_lines = {'A': line('A', 1), 'B': line('B', 2)}
+        with HTTMock(mouser_mock):
+            data = Mouser.diff_mouser_cart(self, 'abc', last_lines, {'A': line('A', 1), 'B': line('B', 5), 'C': line('C', 1)}, 'DE')
+        self.assertEqual(data['changes'], {'inserted': 1, 'updated': 1, 'removed': 0})
+        self.assertEqual([r[1] for r in requests], ['/api/v001/cart/items/insert', '/api/v001/cart/items/update'])
+        self.assertEqual(json.loads(requests[0][2])['CartItems'], [line('C', 1)])
+        self.assertEqual(json.loads(requests[1][2])['CartItems'], [line('B', 5)])
+
+        requests.clear()
+        with HTTMock(mouser_mock):
+            data = Mouser.diff_mouser_cart(self, 'abc', last_lines, {'A': line('A', 1)}, 'DE')
+        self.assertEqual(data['changes'], {'inserted': 0, 'updated': 0, 'removed': 1})
+        self.assertEqual([r[1] for r in requests], ['/api/v001/cart/item/remove'])
+
+        # Without changes the cart is only read
+        requests.clear()
+        with HTTMock(mouser_mock):
+            data = Mouser.diff_mouser_cart(self, 'abc', last_lines, dict(last_lines), 'DE')
+        self.assertEqual([r[0] for r in requests], ['GET'])
+        self.assertEqual(data['cart_key'], 'abc')
 # ----------------------------------------------------------------------------
 # Here comes the Farnell stuff
 
     def test_create_farnell_cart(self):
-        data = Farnell.create_farnell_cart(self, 0)
-        self.assertEqual(data['ID'], '')
-        self.assertEqual(data['error_status'], 'Not supported yet')
+        data = Farnell.create_farnell_cart(self, SimpleNamespace(reference='PO-0001'))
+        self.assertEqual(data['ID'], 'PO-0001')
+        self.assertEqual(data['error_status'], 'OK')
+
+    def test_get_farnell_partdata_many(self):
+
+        headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
+        urls = []
+
+        @urlmatch(netloc=r'(.*\.)?api\.element14\.com.*')
+        def mock(url, request):
+            urls.append(request.url)
+            products = [{'sku': sku,
+                         'displayName': 'Part ' + sku,
+                         'translatedMinimumOrderQuality': 5,
+                         'unitOfMeasure': 'EACH',
+                         'translatedManufacturerPartNumber': 'MPN' + sku,
+                         'vendorName': 'VISHAY',
+                         'productStatus': 'STOCKED',
+                         'stock': {'level': 100},
+                         'prices': [{'to': 99, 'from': 5, 'cost': 0.5}, {'to': 999999999, 'from': 100, 'cost': 0.25}],
+                         } for sku in ['2', '1']]
+            return response(200, {'premierFarnellPartNumberReturn': {'numberOfResults': 2, 'products': products}}, headers, None, 5, request)
+
+        with HTTMock(mock):
+            data = Farnell.get_farnell_partdata_many(self, ['1', '2', '3'], 'none')
+        self.assertEqual(len(urls), 1)
+        self.assertIn('term=id:1,2,3&', urls[0])
+        self.assertEqual(data['1']['MPN'], 'MPN1')
+        self.assertEqual(data['2']['MPN'], 'MPN2')
+        self.assertEqual(data['2']['stock'], 100)
+        self.assertEqual(data['3']['error_status'], 'Part with SKU "3" not found in Farnell catalog!')
+        self.assertIn('storeInfo.id=de.farnell.com&', urls[0])
+        self.assertIn('responseGroup=large&', urls[0])
+        self.assertEqual(data['1']['price_breaks'][0]['Currency'], 'EUR')
+
+        # Shop and currency come from the settings. Price lookups use the small group
+        SettingsMixin.set_setting(self, key='FARNELL_STORE', value='uk.farnell.com')
+        SettingsMixin.set_setting(self, key='FARNELL_CURRENCY', value='GBP')
+        with HTTMock(mock):
+            prices = Farnell.get_farnell_partdata_many(self, ['1'], 'prices')
+        self.assertIn('storeInfo.id=uk.farnell.com&', urls[1])
+        self.assertIn('responseGroup=small&', urls[1])
+        self.assertEqual(prices['1']['price_breaks'][0]['Currency'], 'GBP')
+
+        # An answer without prices is an error and not an empty list of price breaks
+        @urlmatch(netloc=r'(.*\.)?api\.element14\.com.*')
+        def mock_without_prices(url, request):
+            products = [{'sku': '1', 'displayName': 'Part 1', 'stock': {'level': 100}}]
+            return response(200, {'premierFarnellPartNumberReturn': {'numberOfResults': 1, 'products': products}}, headers, None, 5, request)
+
+        with HTTMock(mock_without_prices):
+            prices = Farnell.get_farnell_partdata_many(self, ['1'], 'prices')
+        self.assertEqual(prices['1']['error_status'], 'Farnell sent no prices for SKU "1"')
+        self.assertNotIn('price_breaks', prices['1'])
+        SettingsMixin.set_setting(self, key='FARNELL_STORE', value='de.farnell.com')
+        SettingsMixin.set_setting(self, key='FARNELL_CURRENCY', value='EUR')
+
+        # The cart items of the found parts
+        line = {'SKU': '1', 'Quantity': 150, 'IPN': 'R-1'}
+        item = Farnell.get_farnell_cart_item(self, line, data['1'])
+        self.assertEqual(item['UnitPrice'], 0.25)
+        self.assertEqual(item['ExtendedPrice'], 37.5)
+        self.assertEqual(item['QuantityAvailable'], 100)
+        self.assertEqual(item['Manufacturer'], 'VISHAY')
+        item = Farnell.get_farnell_cart_item(self, dict(line, Quantity=2), data['1'])
+        self.assertEqual(item['Error'], 'Minimum order quantity not reached')
+        self.assertTrue(item['HasError'])
+        item = Farnell.get_farnell_cart_item(self, dict(line, SKU='3'), data['3'])
+        self.assertEqual(item['UnitPrice'], 0)
+        self.assertTrue(item['HasError'])
 
     def test_get_farnell_partdata_errors(self):
 
@@ -234,3 +453,714 @@ class TestCartPlugin(TestCase, SettingsMixin, InvenTreePlugin):
         self.assertEqual(data['lifecycle_status'], 'STOCKED')
         self.assertEqual(data['pack_quantity'], '10')
         self.assertEqual(data['package'], 'STÜCK (GURTABSCHNITT)')
+
+# ----------------------------------------------------------------------------
+# Here comes the Digikey stuff
+
+    def test_digikey_listname(self):
+
+        used_names = ['PO-0012-01', 'PO-0012-07', 'PO-00123-09', 'Other list', 'PO-0012-x']
+        self.assertEqual(Digikey.get_next_list_version(self, 'PO-0012', used_names), 8)
+        self.assertEqual(Digikey.get_next_list_version(self, 'PO-0013', used_names), 1)
+        self.assertEqual(Digikey.get_order_listnames(self, 'PO-0012', used_names + ['PO-0012-01']), ['PO-0012-01', 'PO-0012-07'])
+
+    def test_digikey_token_cache(self):
+
+        # The token is refreshed only once and then taken from the cache
+        digikey.token_cache['access_token'] = None
+        digikey.token_cache['expires_at'] = 0
+        headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
+        content = {'access_token': 'access1', 'refresh_token': 'refresh1', 'expires_in': 1799}
+        calls = []
+
+        @urlmatch(netloc=r'(.*\.)?api\.digikey\.com.*', path=r'/v1/oauth2/token')
+        def digikey_mock(url, request):
+            calls.append(url)
+            return response(200, content, headers, None, 5, request)
+
+        with HTTMock(digikey_mock):
+            Digikey.get_digikey_access_token(self)
+            token = Digikey.get_digikey_access_token(self)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(token['status_code'], 200)
+        self.assertEqual(token['access_token'], 'access1')
+        self.assertEqual(Digikey.get_access_token(self), 'access1')
+        self.assertEqual(SettingsMixin.get_setting(self, 'DIGIKEY_REFRESH_TOKEN'), 'refresh1')
+
+        # Another process takes the stored token and does not refresh again
+        digikey.token_cache['access_token'] = None
+        digikey.token_cache['expires_at'] = 0
+        with HTTMock(digikey_mock):
+            token = Digikey.get_digikey_access_token(self)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(token['access_token'], 'access1')
+        self.assertGreater(digikey.token_cache['expires_at'], time.time() + 1700)
+
+        # An invalid token is refreshed on the next call, also in the other processes
+        Digikey.invalidate_digikey_token(self)
+        self.assertEqual(SettingsMixin.get_setting(self, 'DIGIKEY_TOKEN_EXPIRES'), '0')
+        with HTTMock(digikey_mock):
+            Digikey.get_digikey_access_token(self)
+        self.assertEqual(len(calls), 2)
+
+    # -------------------------------------------------------------------------
+    # The list parts are uploaded in chunks. Failed chunks are retried.
+
+    def test_upload_digikey_parts(self):
+
+        SettingsMixin.set_setting(self, key='DIGIKEY_CHUNK_SIZE', value='2')
+        headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
+        cart_items = [{'RequestedPartNumber': sku, 'Quantities': [{'Quantity': 1}], 'CustomerReference': None} for sku in 'ABCAFGE']
+        requests = []
+        parts_list = []
+
+        @urlmatch(netloc=r'(.*\.)?api\.digikey\.com.*')
+        def digikey_mock(url, request):
+            if request.method == 'GET':
+                return response(200, {'PartsList': list(parts_list)}, headers, None, 5, request)
+            items = [dict(item, CustomerReference=item['CustomerReference'] or '') for item in json.loads(request.body)]
+            skus = ''.join(item['RequestedPartNumber'] for item in items)
+            requests.append(skus)
+            if skus == 'E':
+                return response(400, {}, headers, None, 5, request)
+            # CA: Digikey adds C and fails. A is in the list from the other chunk
+            # anyway. FG: Digikey adds both and the answer is lost.
+            if skus == 'CA':
+                parts_list.append(items[0])
+                return response(503, {}, headers, None, 5, request)
+            parts_list.extend(items)
+            if skus == 'FG':
+                raise request_wrappers.requests.exceptions.ReadTimeout()
+            return response(200, {}, headers, None, 5, request)
+
+        digikey.CHUNK_RETRY_DELAY = 0
+        try:
+            with HTTMock(digikey_mock):
+                errors = Digikey.upload_digikey_parts(self, 'list', cart_items)
+        finally:
+            digikey.CHUNK_RETRY_DELAY = 1
+        self.assertEqual(sorted(requests), ['A', 'AB', 'CA', 'E', 'FG'])
+        self.assertEqual(sorted(p['RequestedPartNumber'] for p in parts_list), ['A', 'A', 'B', 'C', 'F', 'G'])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('400'))
+
+# ----------------------------------------------------------------------------
+# Here comes the supplier part creation
+
+    def test_create_supplierparts(self):
+
+        supplier = Company.objects.create(name='Mouser', is_supplier=True, currency='EUR')
+        manufacturer = Company.objects.create(name='TI', is_manufacturer=True)
+        part = Part.objects.create(name='NE555', description='Timer', purchaseable=True)
+        mpart = ManufacturerPart.objects.create(part=part, manufacturer=manufacturer, MPN='NE555P')
+
+        # Bad IDs give a message for the line and not an exception
+        lines = [{'pk': part.pk, 'supplier': supplier.pk, 'mpart': mpart.pk, 'sku': '595-NE555P'},
+                 {'pk': 'abc', 'supplier': supplier.pk, 'mpart': mpart.pk, 'sku': '595-NE555P'},
+                 {'pk': part.pk, 'supplier': supplier.pk, 'sku': '595-NE555P'},
+                 ]
+        prepared = SupplierCartPanel.prepare_supplierparts(self, lines)
+        self.assertEqual(prepared[0]['message'], 'OK')
+        self.assertEqual(prepared[1]['message'], 'Invalid part, supplier or manufacturer part ID')
+        self.assertEqual(prepared[2]['message'], 'Invalid part, supplier or manufacturer part ID')
+
+        # A line that fails does not roll back the others
+        data = {'SKU': '595-NE555P',
+                'URL': '',
+                'lifecycle_status': '',
+                'package': '',
+                'pack_quantity': '1',
+                'description': 'Timer',
+                'price_breaks': [{'Quantity': 1, 'Price': 0.5, 'Currency': 'EUR'}],
+                }
+        lines = [dict(prepared[0], data=data), dict(prepared[0], data=data)]
+        SupplierCartPanel.create_supplierparts(self, lines)
+        self.assertEqual(lines[0]['message'], 'OK')
+        self.assertTrue(lines[1]['message'].startswith('Supplierpart could not be created'))
+        sp = SupplierPart.objects.get(part=part, supplier=supplier)
+        self.assertEqual(sp.pricebreaks.count(), 1)
+
+        # The bulk endpoint checks the permission and the request
+        def post(user, body):
+            request = RequestFactory().post('/', data=body, content_type='application/json')
+            request.user = user
+            return SupplierCartPanel.add_supplierparts(self, request)
+
+        admin = get_user_model().objects.create_superuser(username='admin', email='admin@example.com', password='admin')
+        user = get_user_model().objects.create_user(username='user', password='user')
+        self.assertEqual(post(user, json.dumps({'lines': []})).status_code, 403)
+        self.assertEqual(post(admin, 'no json').status_code, 400)
+        self.assertEqual(post(admin, json.dumps({'supplier': supplier.pk})).status_code, 400)
+        self.assertEqual(post(admin, json.dumps({'lines': ['abc']})).status_code, 400)
+        self.assertEqual(post(admin, json.dumps({'bom': 'abc', 'supplier': supplier.pk})).status_code, 400)
+        self.assertEqual(post(admin, json.dumps({'bom': part.pk})).status_code, 400)
+        self.assertEqual(post(admin, json.dumps({'bom': part.pk + 1000, 'supplier': supplier.pk})).status_code, 404)
+
+# ----------------------------------------------------------------------------
+# Here comes the price refresh. The lookups are replaced by a fake that returns
+# the part data from a dict.
+
+    def test_price_refresh(self):
+
+        supplier = Company.objects.create(name='Mouser', is_supplier=True, currency='EUR')
+        part = Part.objects.create(name='NE555', description='Timer', purchaseable=True)
+        sp1 = SupplierPart.objects.create(part=part, supplier=supplier, SKU='A')
+        sp2 = SupplierPart.objects.create(part=part, supplier=supplier, SKU='B')
+        sp3 = SupplierPart.objects.create(part=part, supplier=supplier, SKU='C')
+        for quantity, price in [(1, '0.5'), (10, '0.4'), (1000, '0.2')]:
+            SupplierPriceBreak.objects.create(part=sp1, quantity=quantity, price=Decimal(price), price_currency='EUR')
+
+        def found(breaks):
+            return {'error_status': 'OK', 'number_of_results': 1,
+                    'price_breaks': [{'Quantity': q, 'Price': p, 'Currency': 'EUR'} for q, p in breaks]}
+        part_data = {'A': found([(1, 0.5), (10, 0.35), (100, 0.3)]),
+                     'B': {'error_status': 'TooManyRequests'},
+                     'C': {'error_status': 'OK', 'number_of_results': 0},
+                     }
+        lookups = []
+
+        class FakeLookup():
+            def get_partdata_many(self, lookups_of_chunk, use_cache=True):
+                lookups.append(lookups_of_chunk)
+                if part_data is None:
+                    raise RuntimeError('Lookup failed')
+                return [part_data[sku] for supplier_pk, sku, options in lookups_of_chunk]
+
+        SettingsMixin.set_setting(self, key='PRICE_REFRESH_CHUNK', value='10')
+        SettingsMixin.set_setting(self, key='PRICE_REFRESH_CURSOR', value='0')
+        SettingsMixin.set_setting(self, key='PRICE_REFRESH_STATUS', value='')
+        price_refresh.ParallelLookup = FakeLookup
+        try:
+            # The rate limit pauses the job after A. Changed, new and removed breaks are written
+            status = PriceRefresh.refresh_price_breaks(self, [supplier.pk])
+            self.assertEqual(status['state'], 'paused')
+            self.assertEqual(status['updated'], 1)
+            self.assertEqual(SettingsMixin.get_setting(self, 'PRICE_REFRESH_CURSOR'), str(sp1.pk))
+            breaks = {int(pb.quantity): pb.price.amount for pb in SupplierPriceBreak.objects.filter(part=sp1)}
+            self.assertEqual(breaks, {1: Decimal('0.5'), 10: Decimal('0.35'), 100: Decimal('0.3')})
+
+            # The next run continues behind the cursor and an unchanged part is not counted
+            part_data['B'] = found([(1, 1.5)])
+            status = PriceRefresh.refresh_price_breaks(self, [supplier.pk])
+            self.assertEqual([sku for supplier_pk, sku, options in lookups[-1]], ['B', 'C'])
+            self.assertEqual(status['state'], 'finished')
+            self.assertEqual(status['updated'], 1)
+            self.assertEqual(status['errors'], 1)
+            self.assertEqual(SettingsMixin.get_setting(self, 'PRICE_REFRESH_CURSOR'), '0')
+            self.assertEqual(SupplierPriceBreak.objects.get(part=sp2).price.amount, Decimal('1.5'))
+            self.assertFalse(SupplierPriceBreak.objects.filter(part=sp3).exists())
+
+            # An error stops the job without blocking the next run
+            part_data = None
+            status = PriceRefresh.refresh_price_breaks(self, [supplier.pk])
+            self.assertEqual(status['state'], 'error')
+            self.assertEqual(status['message'], 'Lookup failed')
+            self.assertEqual(PriceRefresh.get_status(self)['state'], 'error')
+            self.assertEqual(SettingsMixin.get_setting(self, 'PRICE_REFRESH_CURSOR'), '0')
+            part_data = {'A': found([(1, 0.5)]), 'B': found([(1, 1.5)]), 'C': found([])}
+            status = PriceRefresh.refresh_price_breaks(self, [supplier.pk])
+            self.assertEqual(status['state'], 'finished')
+            self.assertEqual(status['updated'], 1)
+        finally:
+            price_refresh.ParallelLookup = ParallelLookup
+
+# ----------------------------------------------------------------------------
+# Here comes the cache stuff
+
+    def test_partdata_cache(self):
+
+        SettingsMixin.set_setting(self, key='PARTDATA_CACHE_TTL', value='3600')
+        PartDataCache.clear_cache(self)
+        part_data = {'error_status': 'OK',
+                     'number_of_results': 1,
+                     'SKU': '1469661',
+                     'price_breaks': [{'Quantity': 10, 'Price': 0.0104, 'Currency': 'EUR'}]}
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 1, '1469661', 'exact'), None)
+        PartDataCache.store_partdata(self, 1, '1469661', 'exact', part_data)
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 1, '1469661', 'exact'), part_data)
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 2, '1469661', 'exact'), None)
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 1, '1469661', 'none'), None)
+
+        # Errors are not cached
+        PartDataCache.store_partdata(self, 1, 'blabla', 'exact', {'error_status': 'TooManyRequests'})
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 1, 'blabla', 'exact'), None)
+
+        # The least recently used entry is dropped
+        SettingsMixin.set_setting(self, key='PARTDATA_CACHE_SIZE', value='1')
+        PartDataCache.store_partdata(self, 1, '1469662', 'exact', part_data)
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 1, '1469661', 'exact'), None)
+
+        # The file survives the in memory cache
+        with tempfile.TemporaryDirectory() as directory:
+            SettingsMixin.set_setting(self, key='PARTDATA_CACHE_FILE', value=os.path.join(directory, 'cache.sqlite'))
+            PartDataCache.store_partdata(self, 1, '1469661', 'exact', part_data)
+            partdata_cache.memory_cache.clear()
+            self.assertEqual(PartDataCache.get_cached_partdata(self, 1, '1469661', 'exact'), part_data)
+            PartDataCache.clear_cache(self)
+            self.assertEqual(PartDataCache.get_cached_partdata(self, 1, '1469661', 'exact'), None)
+            SettingsMixin.set_setting(self, key='PARTDATA_CACHE_FILE', value='')
+
+        # Each Farnell shop has its own entries
+        SettingsMixin.set_setting(self, key='PARTDATA_CACHE_SIZE', value='10')
+        SettingsMixin.set_setting(self, key='FARNELL_PK', value='3')
+        SettingsCache.invalidate(self)
+        PartDataCache.store_partdata(self, 3, '1469661', 'exact', part_data)
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 3, '1469661', 'exact'), part_data)
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 3, '1469661', 'prices'), None)
+        SettingsMixin.set_setting(self, key='FARNELL_STORE', value='uk.farnell.com')
+        SettingsCache.invalidate(self)
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 3, '1469661', 'exact'), None)
+        SettingsMixin.set_setting(self, key='FARNELL_STORE', value='de.farnell.com')
+        SettingsMixin.set_setting(self, key='FARNELL_PK', value='')
+        SettingsCache.invalidate(self)
+
+        # A time of 0 disables the cache
+        SettingsMixin.set_setting(self, key='PARTDATA_CACHE_TTL', value='0')
+        PartDataCache.store_partdata(self, 1, '1469661', 'exact', part_data)
+        self.assertEqual(PartDataCache.get_cached_partdata(self, 1, '1469661', 'exact'), None)
+
+# ----------------------------------------------------------------------------
+# Here comes the parallel lookup. The plugin is replaced by a fake with batches
+# of 3 for supplier 1 and single lookups for supplier 2.
+
+    def test_parallel_lookup(self):
+
+        calls = []
+
+        class FakePlugin():
+            def get_setting(self, key):
+                return {'MAX_WORKERS': '4', 'SUPPLIER_CONCURRENCY': '2'}.get(key, '')
+
+            def get_batch_size(self, supplier):
+                return {1: 3}.get(supplier, 1)
+
+            def get_partdata(self, supplier, sku, options, use_cache=True):
+                calls.append((supplier, [sku], options))
+                if sku == 'limited':
+                    raise request_wrappers.TooManyRequests
+                if sku == 'offline':
+                    raise ConnectionError
+                return {'error_status': 'OK', 'SKU': sku, 'options': options}
+
+            def get_partdata_batch(self, supplier, skus, options, use_cache=True):
+                calls.append((supplier, skus, options))
+                return {sku: {'error_status': 'OK', 'SKU': sku, 'options': options} for sku in skus}
+
+        plugin = FakePlugin()
+        lookups = [(1, 'A', 'exact'), (2, 'X', 'exact'), (1, 'B', 'exact'), (1, 'A', 'exact'), (1, 'C', 'prices'),
+                   (1, 'D', 'exact'), (1, 'E', 'exact'), (2, 'limited', 'exact'), (2, 'offline', 'exact')]
+
+        # Batches per supplier and options, single lookups for the others
+        tasks = ParallelLookup.get_tasks(plugin, list(dict.fromkeys(lookups)))
+        self.assertEqual(tasks, [[(2, 'X', 'exact')], [(2, 'limited', 'exact')], [(2, 'offline', 'exact')],
+                                 [(1, 'A', 'exact'), (1, 'B', 'exact'), (1, 'D', 'exact')], [(1, 'E', 'exact')],
+                                 [(1, 'C', 'prices')]])
+
+        # The results are in the order of the lookups and A is searched only once
+        results = ParallelLookup.get_partdata_many(plugin, lookups)
+        self.assertEqual([data.get('SKU') for data in results], ['A', 'X', 'B', 'A', 'C', 'D', 'E', None, None])
+        self.assertEqual(results[4]['options'], 'prices')
+        self.assertEqual(sorted(sku for supplier, skus, options in calls for sku in skus), ['A', 'B', 'C', 'D', 'E', 'X', 'limited', 'offline'])
+        self.assertIn((1, ['A', 'B', 'D'], 'exact'), calls)
+        self.assertIn((1, ['C'], 'prices'), calls)
+
+        # Errors of the requests become error states
+        self.assertEqual(results[7], {'error_status': 'TooManyRequests'})
+        self.assertEqual(results[8], {'error_status': 'Connection to supplier failed'})
+        self.assertEqual(ParallelLookup.get_partdata_many(plugin, []), [])
+
+# ----------------------------------------------------------------------------
+# Here comes the HTTP session pool
+
+    def test_session_pool(self):
+
+        Wrappers.close_sessions(self)
+        SettingsMixin.set_setting(self, key='HTTP_POOL_SIZE', value='10')
+        session = Wrappers.get_session(self, 'https://api.mouser.com/api/v1.0/search')
+        self.assertIs(Wrappers.get_session(self, 'https://api.mouser.com/api/v1.0/cart'), session)
+        self.assertIsNot(Wrappers.get_session(self, 'https://api.digikey.com/v1/oauth2/token'), session)
+        self.assertEqual(session.pool_size, 10)
+
+        # A new pool size gives a new session. The old one is not closed under running requests
+        closed = []
+        session.close = lambda: closed.append(session)
+        SettingsMixin.set_setting(self, key='HTTP_POOL_SIZE', value='2')
+        new_session = Wrappers.get_session(self, 'https://api.mouser.com/api/v1.0/search')
+        self.assertIsNot(new_session, session)
+        self.assertEqual(new_session.pool_size, 2)
+        self.assertEqual(closed, [])
+        SettingsMixin.set_setting(self, key='HTTP_POOL_SIZE', value='10')
+
+        # Only a connection that could not be opened means that nothing was sent
+        self.assertTrue(Wrappers.is_connect_error(self, request_wrappers.requests.exceptions.ConnectTimeout()))
+        self.assertFalse(Wrappers.is_connect_error(self, request_wrappers.requests.exceptions.ReadTimeout()))
+        with self.assertRaises(request_wrappers.RequestNotSent):
+            Wrappers.post_request(self, '{}', 'http://127.0.0.1:9/', {})
+        Wrappers.close_sessions(self)
+
+# ----------------------------------------------------------------------------
+# Here comes the rate limit stuff
+
+    def test_rate_limit(self):
+
+        request_wrappers.buckets.clear()
+
+        # Digikey reports the remaining requests in the header
+        Wrappers.update_rate_limit(self, 'api.digikey.com', {'X-RateLimit-Remaining': '117', 'X-RateLimit-Limit': '120'}, 200)
+        stats = Wrappers.get_rate_limit_stats(self)['api.digikey.com']
+        self.assertEqual(stats['remaining'], 117)
+        self.assertEqual(stats['limit'], 120)
+        self.assertEqual(stats['blocked_for'], 0)
+
+        # 429 blocks the host for Retry-After seconds
+        Wrappers.update_rate_limit(self, 'api.digikey.com', {'Retry-After': '20'}, 429)
+        self.assertGreater(Wrappers.get_rate_limit_stats(self)['api.digikey.com']['blocked_for'], 15)
+
+        # Mouser reports the exhausted quota in the body
+        Wrappers.report_rate_limit(self, 'https://api.mouser.com/api/v1.0/search/partnumber', retry_after=10)
+        self.assertEqual(Wrappers.get_rate_limit_stats(self)['api.mouser.com']['remaining'], 0)
+
+        # The Farnell bucket allows 2 requests at once and then 2 per second
+        start = time.monotonic()
+        for i in range(3):
+            Wrappers.acquire_rate_limit(self, 'api.element14.com')
+        self.assertGreater(time.monotonic() - start, 0.4)
+        stats = Wrappers.get_rate_limit_stats(self)['api.element14.com']
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['throttled'], 1)
+
+        # A host that is blocked for longer than MAX_WAIT gets no request at all
+        Wrappers.report_rate_limit(self, 'https://api.element14.com/catalog/products', retry_after=60)
+        start = time.monotonic()
+        with self.assertRaises(request_wrappers.TooManyRequests):
+            Wrappers.acquire_rate_limit(self, 'api.element14.com')
+        self.assertLess(time.monotonic() - start, 1)
+        stats = Wrappers.get_rate_limit_stats(self)['api.element14.com']
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['rejected'], 1)
+        request_wrappers.buckets.clear()
+
+# ----------------------------------------------------------------------------
+# Here comes the settings snapshot
+
+    def test_settings_cache(self):
+
+        SettingsCache.invalidate(self)
+        loads = []
+
+        def load():
+            loads.append(1)
+            return 'https'
+
+        # The second read comes from the snapshot
+        self.assertEqual(SettingsCache.get_setting(self, 'PROXY_CON', load), 'https')
+        self.assertEqual(SettingsCache.get_setting(self, 'PROXY_CON', load), 'https')
+        self.assertEqual(len(loads), 1)
+
+        # Saving any setting drops the snapshot
+        SettingsMixin.set_setting(self, key='PROXY_URL', value='http://proxy:3128')
+        SettingsCache.get_setting(self, 'PROXY_CON', load)
+        self.assertEqual(len(loads), 2)
+
+        # The Digikey tokens are always read from the database
+        SettingsCache.get_setting(self, 'DIGIKEY_TOKEN', load)
+        SettingsCache.get_setting(self, 'DIGIKEY_TOKEN', load)
+        self.assertEqual(len(loads), 4)
+
+        # A change in another process is found with the fingerprint after SNAPSHOT_TTL
+        SettingsCache.get_setting(self, 'PROXY_CON', load)
+        self.assertEqual(len(loads), 4)
+        settings_cache.snapshot['version'] = 'changed by another process'
+        settings_cache.snapshot['checked'] = 0
+        SettingsCache.get_setting(self, 'PROXY_CON', load)
+        self.assertEqual(len(loads), 5)
+        self.assertEqual(settings_cache.snapshot['version'], SettingsCache.read_version(self))
+        settings_cache.snapshot['checked'] = 0
+        SettingsCache.get_setting(self, 'PROXY_CON', load)
+        self.assertEqual(len(loads), 5)
+        SettingsMixin.set_setting(self, key='PROXY_URL', value='')
+
+# ----------------------------------------------------------------------------
+# Here comes the supplier registry
+
+    def test_supplier_registry(self):
+
+        SettingsMixin.set_setting(self, key='MOUSER_PK', value='7')
+        SettingsCache.invalidate(self)
+        registry = SupplierRegistry.get_registry(self)
+        self.assertEqual(registry['by_pk'][7]['name'], 'Mouser')
+        self.assertEqual(SupplierRegistry.get_supplier(self, 7)['batch_size'], Mouser.BATCH_SIZE)
+        self.assertEqual(SupplierRegistry.get_supplier(self, 8), None)
+        self.assertEqual(SupplierCartPanel.get_batch_size(self, 7), Mouser.BATCH_SIZE)
+        self.assertEqual(SupplierCartPanel.get_batch_size(self, 8), 1)
+
+        # The registry is shared until a setting changes and can not be modified
+        self.assertIs(SupplierRegistry.get_registry(self), registry)
+        with self.assertRaises(TypeError):
+            registry['by_pk'][8] = registry['by_pk'][7]
+        SettingsMixin.set_setting(self, key='MOUSER_PK', value='')
+        SettingsCache.invalidate(self)
+        self.assertEqual(SupplierRegistry.get_supplier(self, 7), None)
+
+# ----------------------------------------------------------------------------
+# Here comes the cart export
+
+    def test_cart_export(self):
+
+        row = {'order': 'PO-0001',
+               'supplier': 'Mouser',
+               'SKU': '595-NE555P',
+               'IPN': 'IC-555',
+               'Manufacturer': 'Texas Instruments',
+               'MPN': 'NE555P',
+               'Description': 'Timer, "precision"',
+               'QuantityRequested': 10,
+               'QuantityAvailable': 5000,
+               'UnitPrice': 0.52,
+               'ExtendedPrice': 5.2,
+               'currency_code': 'EUR',
+               'Error': '',
+               'price_breaks': [{'quantity': '1', 'price': '0.61', 'currency': 'EUR'},
+                                {'quantity': '10', 'price': '0.52', 'currency': 'EUR'}],
+               }
+        lines = list(CartExport.csv_lines(self, iter([row, row])))
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], ','.join(cart_export.FIELDS) + '\r\n')
+        self.assertEqual(lines[1], 'PO-0001,Mouser,595-NE555P,IC-555,Texas Instruments,NE555P,'
+                                   '"Timer, ""precision""",10,5000,0.52,5.2,EUR,,1:0.61 10:0.52\r\n')
+
+        lines = list(CartExport.quick_paste_lines(self, iter([row, dict(row, SKU='595-NE556N', HasError=True)])))
+        self.assertEqual(lines, ['595-NE555P, 10, IC-555\n'])
+
+        lines = list(CartExport.ndjson_lines(self, iter([row])))
+        self.assertEqual(json.loads(lines[0]), row)
+        self.assertTrue(lines[0].endswith('}\n'))
+
+    def test_cart_snapshot(self):
+
+        supplier = Company.objects.create(name='Mouser', is_supplier=True, currency='EUR')
+        order = PurchaseOrder.objects.create(reference=PurchaseOrder.generate_reference(), supplier=supplier)
+        item = {'SKU': '595-NE555P',
+                'IPN': 'IC-555',
+                'Manufacturer': 'Texas Instruments',
+                'MPN': 'NE555P',
+                'Description': 'Timer',
+                'QuantityRequested': 10,
+                'QuantityAvailable': 5000,
+                'UnitPrice': 0.52,
+                'ExtendedPrice': 5.2,
+                'Error': '',
+                'HasError': False,
+                }
+        cart_data = {'MerchandiseTotal': 5.2, 'CartItems': [item], 'cart_key': 'abc', 'currency_code': 'EUR', 'cart_date': '2026-01-02'}
+        pointer = CartSnapshots.store_snapshot(self, order, cart_data)
+        MetaAccess.set_value(self, order, 'cart', pointer)
+        self.assertEqual(pointer['lines'], 1)
+        self.assertNotIn('CartItems', pointer)
+
+        # A second transfer keeps the first one in the history
+        cart_data['cart_date'] = '2026-01-03'
+        cart_data['CartItems'] = [item, dict(item, SKU='595-NE556N', IPN=None, QuantityAvailable='many', ExtendedPrice=7, HasError=True)]
+        MetaAccess.set_value(self, order, 'cart', CartSnapshots.store_snapshot(self, order, cart_data))
+        cart = CartSnapshots.get_cart(self, order)
+        self.assertEqual(cart['cart_date'], '2026-01-03')
+        self.assertEqual(cart['CartItems'][0], item)
+        self.assertEqual(cart['CartItems'][1]['IPN'], '')
+        self.assertEqual(cart['CartItems'][1]['QuantityAvailable'], 0)
+        history = CartSnapshots.get_history(self, order)
+        self.assertEqual([entry['cart_date'] for entry in history], ['2026-01-03', '2026-01-02'])
+        self.assertEqual(len(CartSnapshots.get_cart(self, order, pointer['snapshot'])['CartItems']), 1)
+
+        # The next Mouser transfer reuses the key and diffs against the snapshot
+        self.assertEqual(Mouser.create_mouser_cart(self, order)['ID'], 'abc')
+        last_lines = Mouser.get_last_mouser_lines(self, CartSnapshots.get_snapshot(self, order))
+        self.assertEqual(last_lines['595-NE555P'], {'MouserPartNumber': '595-NE555P', 'Quantity': 10, 'CustomerPartNumber': 'IC-555'})
+        self.assertEqual(last_lines['595-NE556N']['CustomerPartNumber'], '')
+
+        rows = list(CartExport.get_rows(self, [order.pk]))
+        self.assertEqual([row['SKU'] for row in rows], ['595-NE555P', '595-NE556N'])
+        self.assertEqual(rows[0]['currency_code'], 'EUR')
+
+        # Paging, sorting and filtering
+        snapshot = CartSnapshots.get_snapshot(self, order)
+        page = CartSnapshots.get_page(self, snapshot, 0, 1, '-ExtendedPrice')
+        self.assertEqual(page['count'], 2)
+        self.assertEqual([line['SKU'] for line in page['CartItems']], ['595-NE556N'])
+        page = CartSnapshots.get_page(self, snapshot, 1, 1, '-ExtendedPrice')
+        self.assertEqual([line['SKU'] for line in page['CartItems']], ['595-NE555P'])
+        page = CartSnapshots.get_page(self, snapshot, filter='errors')
+        self.assertEqual([line['SKU'] for line in page['CartItems']], ['595-NE556N'])
+        page = CartSnapshots.get_page(self, snapshot, filter='unavailable')
+        self.assertEqual(page['count'], 1)
+        self.assertEqual(page['CartItems'][0]['QuantityAvailable'], 0)
+
+        # Carts of older plugin versions are moved from the metadata into a snapshot.
+        # They have no HasError. Items without MPN and manufacturer are errors.
+        legacy_item = {key: value for key, value in item.items() if key not in ['MPN', 'Manufacturer', 'HasError']}
+        legacy_cart = dict(cart_data, CartItems=[{key: value for key, value in item.items() if key != 'HasError'}, legacy_item])
+        MetaAccess.set_value(self, order, 'cart', legacy_cart)
+        stale_order = PurchaseOrder.objects.get(pk=order.pk)
+        cart = CartSnapshots.get_cart(self, order)
+        self.assertEqual(len(cart['CartItems']), 2)
+        self.assertEqual([line['HasError'] for line in cart['CartItems']], [False, True])
+        self.assertNotIn('CartItems', MetaAccess.get_value(self, order, 'cart'))
+        self.assertNotIn('CartItems', MetaAccess.get_value(self, PurchaseOrder.objects.get(pk=order.pk), 'cart'))
+        self.assertEqual(len(CartSnapshots.get_history(self, order)), 3)
+
+        # A second reader that still has the old metadata does not move it again
+        CartSnapshots.get_cart(self, stale_order)
+        self.assertEqual(len(CartSnapshots.get_history(self, order)), 3)
+
+        # A long transfer writes into an old instance. Changes made meanwhile are kept
+        other = PurchaseOrder.objects.get(pk=order.pk)
+        other.description = 'Changed during transfer'
+        other.metadata['otherplugin'] = {'key': 'value'}
+        other.save()
+        MetaAccess.set_value(self, stale_order, 'cart_job', {'state': 'done'})
+        order = PurchaseOrder.objects.get(pk=order.pk)
+        self.assertEqual(order.description, 'Changed during transfer')
+        self.assertEqual(order.metadata['otherplugin'], {'key': 'value'})
+        self.assertEqual(MetaAccess.get_value(self, order, 'cart_job'), {'state': 'done'})
+        self.assertNotIn('CartItems', MetaAccess.get_value(self, order, 'cart'))
+
+    # -------------------------------------------------------------------------
+    def test_write_back_prices(self):
+
+        supplier = Company.objects.create(name='Mouser', is_supplier=True, currency='EUR')
+        part = Part.objects.create(name='NE555', description='Timer', purchaseable=True)
+        order = PurchaseOrder.objects.create(reference=PurchaseOrder.generate_reference(), supplier=supplier)
+        lines = {}
+        for sku in ['A', 'B', 'C']:
+            sp = SupplierPart.objects.create(part=part, supplier=supplier, SKU=sku)
+            lines[sku] = PurchaseOrderLineItem.objects.create(order=order, part=sp, quantity=10)
+        item = {'SKU': 'A', 'UnitPrice': 0.25, 'HasError': False}
+        cart_data = {'currency_code': 'USD',
+                     'CartItems': [item, dict(item, SKU='B', UnitPrice=0, HasError=True), dict(item, SKU='D')],
+                     }
+
+        # Only A is in the order and has no error
+        self.assertEqual(SupplierCartPanel.write_back_prices(self, order, cart_data), 1)
+        line = PurchaseOrderLineItem.objects.get(pk=lines['A'].pk)
+        self.assertEqual(line.purchase_price.amount, Decimal('0.25'))
+        self.assertEqual(str(line.purchase_price.currency), 'USD')
+        self.assertIsNone(PurchaseOrderLineItem.objects.get(pk=lines['B'].pk).purchase_price)
+        self.assertIsNone(PurchaseOrderLineItem.objects.get(pk=lines['C'].pk).purchase_price)
+
+# ----------------------------------------------------------------------------
+# Here comes the price comparison
+
+    def test_price_comparison(self):
+
+        data = {'error_status': 'OK',
+                'number_of_results': 1,
+                'moq': 10,
+                'mult': 5,
+                'stock': 100,
+                'price_breaks': [{'Quantity': 100, 'Price': 0.5, 'Currency': 'EUR'},
+                                 {'Quantity': 10, 'Price': 1, 'Currency': 'EUR'},
+                                 {'Quantity': 1000, 'Price': 0.2, 'Currency': 'EUR'}]}
+
+        # The minimum order quantity and the order multiple raise the quantity
+        offer = PriceComparison.get_offer(self, Decimal(3), data, 'EUR')
+        self.assertEqual(offer['order_quantity'], 10)
+        self.assertEqual(offer['total'], 10)
+        offer = PriceComparison.get_offer(self, Decimal(98), data, 'EUR')
+        self.assertEqual(offer['order_quantity'], 100)
+        self.assertEqual(offer['unit_price'], Decimal('0.5'))
+        self.assertTrue(offer['in_stock'])
+        offer = PriceComparison.get_offer(self, Decimal(1000), data, 'EUR')
+        self.assertEqual(offer['unit_price'], Decimal('0.2'))
+        self.assertFalse(offer['in_stock'])
+        offer = PriceComparison.get_offer(self, Decimal(1), {'error_status': 'TooManyRequests'}, 'EUR')
+        self.assertEqual(offer['total'], None)
+
+        # Cheapest and fastest offer
+        line = {'offers': [PriceComparison.get_offer(self, Decimal(98), data, 'EUR'),
+                           PriceComparison.get_offer(self, Decimal(98), dict(data, stock=5, price_breaks=[{'Quantity': 1, 'Price': 0.4, 'Currency': 'EUR'}]), 'EUR')],
+                'cheapest': None,
+                'fastest': None}
+        PriceComparison.select_offers(self, line)
+        self.assertEqual(line['cheapest']['total'], Decimal('40'))
+        self.assertEqual(line['fastest']['total'], Decimal('50'))
+
+    def test_availability_check(self):
+
+        sp = SimpleNamespace(SKU='595-NE555P', pack_quantity='10', part=SimpleNamespace(IPN='IC-555'))
+        data = {'error_status': 'OK',
+                'number_of_results': 1,
+                'stock': 100,
+                'moq': 5,
+                'mult': 5,
+                'price_breaks': [{'Quantity': 10, 'Price': 0.5, 'Currency': 'EUR'}],
+                }
+        line = AvailabilityCheck.check_line(self, SimpleNamespace(pk=1, part=sp, quantity=20), data, False)
+        self.assertEqual(line['problems'], [])
+        self.assertIsNone(line['suggested_quantity'])
+
+        line = AvailabilityCheck.check_line(self, SimpleNamespace(pk=1, part=sp, quantity=3), data, False)
+        self.assertEqual(line['problems'], ['Below the minimum order quantity of 5', 'Not a multiple of 5'])
+        self.assertEqual(line['suggested_quantity'], 10)
+        line = AvailabilityCheck.check_line(self, SimpleNamespace(pk=1, part=sp, quantity=7), data, False)
+        self.assertEqual(line['problems'], ['Below the first price break of 10', 'Not a multiple of 5'])
+
+        # In packs of 10 the 11 packs are 110 parts, more than in stock
+        line = AvailabilityCheck.check_line(self, SimpleNamespace(pk=1, part=sp, quantity=11), data, True)
+        self.assertEqual(line['quantity'], 110)
+        self.assertEqual(line['problems'], ['Only 100 in stock'])
+        self.assertIsNone(line['suggested_quantity'])
+
+        line = AvailabilityCheck.check_line(self, SimpleNamespace(pk=1, part=sp, quantity=1), {'error_status': 'OK', 'number_of_results': 0}, False)
+        self.assertEqual(line['problems'], ['Part not found at the supplier'])
+
+# ----------------------------------------------------------------------------
+# Here comes the mock supplier server
+
+    def test_mock_suppliers(self):
+
+        SettingsMixin.set_setting(self, key='FARNELLSEARCHKEY', value='mock')
+        server = MockSuppliers(rate_limit=2)
+        Wrappers.set_url_override(self, 'api.element14.com', server.start())
+        try:
+            data = Farnell.get_farnell_partdata(self, '1469661', 'none')
+            self.assertEqual(data['error_status'], 'OK')
+            self.assertEqual(data['MPN'], '1469661')
+            data = Farnell.get_farnell_partdata(self, 'UNKNOWN', 'none')
+            self.assertIn('not found', data['error_status'])
+
+            # The third request is over the quota of the server
+            data = Farnell.get_farnell_partdata(self, '1469661', 'none')
+            self.assertIn('Too Many Requests', data['error_status'])
+            self.assertEqual(server.requests[0], ('GET', '/catalog/products'))
+            self.assertEqual(len(server.requests), 3)
+        finally:
+            server.stop()
+            Wrappers.set_url_override(self, 'api.element14.com', None)
+            request_wrappers.buckets.clear()
+
+    def test_instrumentation(self):
+
+        Instrumentation.clear_metrics(self)
+        Instrumentation.start_trace(self)
+        Instrumentation.count(self, 'requests', {'host': 'api.mouser.com'})
+        Instrumentation.count(self, 'requests', {'host': 'api.mouser.com'})
+        Instrumentation.count(self, 'bytes_received', {'host': 'api.mouser.com'}, 1000)
+        Instrumentation.record(self, 'http', 0.2, {'host': 'api.mouser.com'})
+        with Instrumentation.timer(self, 'db'):
+            pass
+        trace = Instrumentation.stop_trace(self)
+        self.assertEqual(trace['counters'], {'requests:api.mouser.com': 2, 'bytes_received:api.mouser.com': 1000})
+        self.assertEqual(trace['stages']['http'], {'count': 1, 'seconds': 0.2})
+        self.assertEqual(trace['stages']['db']['count'], 1)
+        self.assertIsNone(Instrumentation.get_trace(self))
+
+        # Without a trace only the process wide metrics are updated
+        Instrumentation.count(self, 'requests', {'host': 'api.mouser.com'})
+        self.assertIsNone(Instrumentation.stop_trace(self))
+        metrics = Instrumentation.render_metrics(self)
+        self.assertIn('supplier_panel_requests_total{host="api.mouser.com"} 3\n', metrics)
+        self.assertIn('supplier_panel_bytes_received_total{host="api.mouser.com"} 1000\n', metrics)
+        self.assertIn('supplier_panel_stage_seconds_bucket{host="api.mouser.com",stage="http",le="0.1"} 0\n', metrics)
+        self.assertIn('supplier_panel_stage_seconds_bucket{host="api.mouser.com",stage="http",le="0.25"} 1\n', metrics)
+        self.assertIn('supplier_panel_stage_seconds_count{stage="db"} 1\n', metrics)
+        Instrumentation.clear_metrics(self)
+        self.assertEqual(Instrumentation.render_metrics(self), '\n')